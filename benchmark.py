@@ -0,0 +1,170 @@
+"""Compare the thread-per-request and tasklet engines under concurrent load.
+
+This sends the same batch of PagerDuty deliveries through both engines, with
+every Slack call replaced by one that takes a fixed time to answer, and
+reports how long each engine took and how many threads it used.  The thread
+engine is main.app, with each delivery on its own thread as App Engine would
+run it; the tasklet engine is tasklet_engine.handle_many() on one thread.
+
+The SDK's urlfetch stub runs "asynchronous" calls one at a time, so we swap
+in one that runs them in the background like the real urlfetch service does.
+
+Example invocation:
+    $ python benchmark.py ~/google-cloud-sdk --deliveries 200 --latency 0.2
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+import runner
+
+
+def _set_up_sdk(sdk_path):
+    # See runner.main.
+    if os.path.exists(os.path.join(sdk_path, 'platform/google_appengine')):
+        sdk_path = os.path.join(sdk_path, 'platform/google_appengine')
+    runner.fixup_paths(sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+
+def _fake_slack_response():
+    return {'ok': True, 'channel': 'C1', 'ts': '%.6f' % time.time()}
+
+
+def _install_slow_urlfetch(latency):
+    from google.appengine.api import apiproxy_rpc
+    from google.appengine.api import apiproxy_stub_map
+
+    class SlowRPC(apiproxy_rpc.RPC):
+        def _MakeCallImpl(self):
+            self._thread = threading.Thread(target=self._answer)
+            self._thread.start()
+            self._state = apiproxy_rpc.RPC.RUNNING
+
+        def _answer(self):
+            time.sleep(latency)
+            self.response.set_statuscode(200)
+            self.response.set_content(json.dumps(_fake_slack_response()))
+
+        def _WaitImpl(self):
+            self._thread.join()
+            self._state = apiproxy_rpc.RPC.FINISHING
+            self._Callback()
+            return True
+
+    class SlowURLFetchStub(object):
+        def CreateRPC(self):
+            return SlowRPC(stub=self)
+
+    apiproxy_stub_map.apiproxy.ReplaceStub('urlfetch', SlowURLFetchStub())
+
+
+class _SlowSlackSession(object):
+    def __init__(self, latency):
+        self.latency = latency
+
+    def post(self, *args, **kwargs):
+        time.sleep(self.latency)
+        response = _fake_slack_response()
+
+        class Response(object):
+            def json(self):
+                return response
+        return Response()
+
+
+def _deliveries(count, start_id):
+    return [{'messages': [{
+        'id': 'benchmark-%s' % (start_id + i),
+        'type': 'incident.trigger',
+        'data': {'incident': {
+            'id': 'PBENCH%s' % (start_id + i),
+            'urgency': 'low',
+            'html_url': 'https://example.com/',
+            'incident_number': start_id + i,
+            'service': {'id': 'PBENCHMARK'},
+        }},
+    }]} for i in xrange(count)]
+
+
+def _run_thread_engine(deliveries):
+    import webapp2
+    import main
+
+    def deliver(payload):
+        request = webapp2.Request.blank('/pagerduty-feed')
+        request.method = 'POST'
+        request.body = json.dumps(payload)
+        request.get_response(main.app)
+
+    threads = [threading.Thread(target=deliver, args=(payload,))
+               for payload in deliveries]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(threads)
+
+
+def _run_tasklet_engine(deliveries):
+    import tasklet_engine
+    tasklet_engine.handle_many(
+        [('pagerduty', payload) for payload in deliveries])
+    return 1
+
+
+def main(sdk_path, count, latency):
+    _set_up_sdk(sdk_path)
+
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    _install_slow_urlfetch(latency)
+
+    import main as main_module
+    import pager_parrot
+    main_module._slack_session = _SlowSlackSession(latency)
+    # Neither engine should spend its time on logging.
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+
+    posts = count * len(pager_parrot.channels_for_incident(
+        _deliveries(1, 0)[0]['messages'][0]['data']['incident']))
+    print('%s deliveries, %s Slack posts, %.3fs per post' % (
+        count, posts, latency))
+    for i, (name, engine) in enumerate([('thread', _run_thread_engine),
+                                        ('tasklet', _run_tasklet_engine)]):
+        deliveries = _deliveries(count, i * count)
+        start = time.time()
+        threads = engine(deliveries)
+        elapsed = time.time() - start
+        print('%8s engine: %7.3fs, %6.1f deliveries/s, %s threads' % (
+            name, elapsed, count / elapsed, threads))
+
+    bed.deactivate()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        'sdk_path',
+        help='The path to the Google App Engine SDK or the Google Cloud SDK.')
+    parser.add_argument(
+        '--deliveries', type=int, default=200,
+        help='How many webhook deliveries to send through each engine.')
+    parser.add_argument(
+        '--latency', type=float, default=0.2,
+        help='How long each Slack call takes, in seconds.')
+
+    args = parser.parse_args()
+    main(args.sdk_path, args.deliveries, args.latency)
+    sys.exit(0)
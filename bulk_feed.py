@@ -0,0 +1,102 @@
+"""A bulk endpoint for replaying many webhook deliveries in one request.
+
+After an outage, a relay or a replay job may have thousands of buffered
+deliveries to send us.  Rather than one request each, it can POST them all
+to /admin/bulk-feed as newline-delimited JSON: one webhook body per line,
+PagerDuty and new-style Phabricator mixed as they come.  (The legacy
+/phabricator-feed sends form data, not JSON, so it can't be replayed here.)
+
+We read the lines as they arrive and hand them to the tasklet engine (see
+tasklet_engine.py) in batches, so each batch shares its Phabricator lookups
+and its Slack posts go out as fast as Slack will take them.  Each batch gets
+the budget a single webhook request would.  The response is JSON, with the
+result for each line.
+"""
+import json
+import logging
+
+import webapp2
+
+import deadline
+import main
+import tasklet_engine
+import tracing
+
+
+# How many deliveries we hand to the tasklet engine at once.
+_BATCH_SIZE = tasklet_engine._MAX_IN_FLIGHT
+
+
+def _kind(payload):
+    """Return which webhook a parsed body came from, or None if we can't
+    tell."""
+    if not isinstance(payload, dict):
+        return None
+    if 'messages' in payload:
+        return 'pagerduty'
+    if 'object' in payload and 'transactions' in payload:
+        return 'phabricator'
+    return None
+
+
+def _parse_lines(lines):
+    """Yield (line number, kind, payload) for each non-blank line.
+
+    For a line we can't use, kind is None and payload says why.
+    """
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            payload = json.loads(line)
+        except ValueError as e:
+            yield number, None, 'Error: invalid JSON: %s' % e
+            continue
+        kind = _kind(payload)
+        if kind is None:
+            yield number, None, 'Error: not a PagerDuty or Phabricator event'
+        else:
+            yield number, kind, payload
+
+
+def _handle_batch(batch):
+    """Handle a list of (line number, kind, payload), and return a list of
+    their results."""
+    with deadline.started(main._REQUEST_BUDGET.total_seconds(),
+                          main._CRITICAL_RESERVE.total_seconds()):
+        return tasklet_engine.handle_many(
+            [(kind, payload) for _, kind, payload in batch])
+
+
+class BulkFeed(webapp2.RequestHandler):
+    def post(self):
+        results = []
+        batch = []
+        with tracing.trace(self.request.path):
+            for number, kind, payload in _parse_lines(self.request.body_file):
+                if kind is None:
+                    results.append(
+                        {'line': number, 'kind': None, 'result': payload})
+                    continue
+                batch.append((number, kind, payload))
+                if len(batch) >= _BATCH_SIZE:
+                    results.extend(self._results(batch))
+                    batch = []
+            if batch:
+                results.extend(self._results(batch))
+
+        results.sort(key=lambda result: result['line'])
+        ok = sum(1 for result in results if result['result'] == 'OK')
+        logging.info("Bulk feed handled %s events, %s OK"
+                     % (len(results), ok))
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({
+            'events': len(results),
+            'ok': ok,
+            'results': results,
+        }))
+
+    def _results(self, batch):
+        return [{'line': number, 'kind': kind, 'result': result}
+                for (number, kind, _), result
+                in zip(batch, _handle_batch(batch))]
@@ -0,0 +1,66 @@
+import json
+import unittest
+
+import mock
+import webapp2
+
+import main
+
+
+def _pagerduty(message_id):
+    return {'messages': [{'id': message_id, 'type': 'incident.trigger',
+                          'data': {'incident': {'id': 'PINCIDENT'}}}]}
+
+
+def _phabricator(phid):
+    return {'object': {'phid': phid}, 'transactions': []}
+
+
+class BulkFeedTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch(
+            'tasklet_engine.handle_many',
+            side_effect=lambda deliveries: ['OK'] * len(deliveries))
+        self.handle_many = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _post(self, lines):
+        request = webapp2.Request.blank('/admin/bulk-feed')
+        request.method = 'POST'
+        request.body = '\n'.join(lines)
+        response = request.get_response(main.app)
+        self.assertEqual(response.status_int, 200)
+        return json.loads(response.body)
+
+    def test_mixed_events(self):
+        summary = self._post([
+            json.dumps(_pagerduty('1')),
+            '',
+            json.dumps(_phabricator('PHID-1')),
+            '{"not": "json"',
+            json.dumps({'who': 'knows'}),
+        ])
+        self.assertEqual(summary['events'], 4)
+        self.assertEqual(summary['ok'], 2)
+        self.assertEqual(
+            [(r['line'], r['kind']) for r in summary['results']],
+            [(1, 'pagerduty'), (3, 'phabricator'), (4, None), (5, None)])
+        self.assertTrue(summary['results'][2]['result'].startswith(
+            'Error: invalid JSON'))
+        self.assertEqual(self.handle_many.call_count, 1)
+        self.assertEqual(self.handle_many.call_args[0][0], [
+            ('pagerduty', _pagerduty('1')),
+            ('phabricator', _phabricator('PHID-1'))])
+
+    def test_batches(self):
+        with mock.patch('bulk_feed._BATCH_SIZE', 2):
+            summary = self._post(
+                [json.dumps(_pagerduty(str(i))) for i in xrange(5)])
+        self.assertEqual(summary['ok'], 5)
+        self.assertEqual(
+            [len(call[0][0]) for call in self.handle_many.call_args_list],
+            [2, 2, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
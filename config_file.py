@@ -0,0 +1,182 @@
+"""Configuration loaded from a JSON file, and reloaded when it changes.
+
+Our routing (which Slack channels hear about which repos, authors and
+incidents) lives in routing.json rather than in the code.  Each module that
+reads it makes a `Watched` with a function to turn the parsed JSON into
+whatever it needs, and calls `get()` to use it.
+
+The deployed file can't change on App Engine, so an admin changes the
+config with `save()` (see /admin/routing in main.py), which stores the new
+contents in the datastore.  If there are stored contents, we use them instead
+of the deployed file; a deploy only sets the config used until someone saves
+one.
+
+`get()` is cheap: most of the time it just returns the current snapshot.
+Every few seconds one caller also checks the stored version (or, if nothing
+is stored, the file's mtime), and if it's changed, builds a new snapshot and
+swaps it in.  Snapshots are never modified once built, so readers need no
+locks, and a request that started with the old snapshot finishes with it.
+If the new config doesn't build (say it's not valid JSON), we log it and
+keep the old snapshot.
+"""
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+from google.appengine.ext import ndb
+
+
+# Set this in the environment to read routing from somewhere else.
+PATH = os.environ.get(
+    'KHAN_WEBHOOKS_ROUTING_FILE',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'routing.json'))
+
+# How often to check whether the file has changed.
+_CHECK_INTERVAL = datetime.timedelta(seconds=5)
+
+# How long to wait before rebuilding an incomplete snapshot, at first and at
+# most; we double the wait after each rebuild that's still incomplete.
+_MIN_RETRY_INTERVAL = datetime.timedelta(seconds=30)
+_MAX_RETRY_INTERVAL = datetime.timedelta(minutes=30)
+
+
+class StoredConfig(ndb.Model):
+    """Saved contents of a config file, keyed by the file's name."""
+    text = ndb.TextProperty()
+    version = ndb.IntegerProperty(indexed=False)
+
+    # We check this every few seconds, from requests and not; the context
+    # cache would only ever give us our own last read back.
+    _use_cache = False
+
+
+def _stored(path):
+    return StoredConfig.get_by_id(os.path.basename(path))
+
+
+def save(path, text):
+    """Store `text` as the contents of the config file at `path`.
+
+    Every instance picks it up within a few seconds.  Returns its version.
+    """
+    @ndb.transactional
+    def save_version():
+        stored = _stored(path) or StoredConfig(
+            id=os.path.basename(path), version=0)
+        stored.text = text
+        stored.version += 1
+        stored.put()
+        return stored.version
+    return save_version()
+
+
+def current_text(path):
+    """Return the contents of the config file at `path` we'd load now."""
+    stored = _stored(path)
+    if stored is not None:
+        return stored.text
+    with open(path) as f:
+        return f.read()
+
+
+class Watched(object):
+    """A snapshot built from a JSON config file, rebuilt when it changes.
+
+    `build(config, previous)` is called with the parsed JSON and the previous
+    snapshot (None the first time), so it can reuse what hasn't changed.  If
+    `incomplete(snapshot)` is given and returns True (say some lookup the
+    build needed failed), we rebuild even if the file hasn't changed, backing
+    off so that a rebuild that keeps failing doesn't eat into every request.
+    """
+    def __init__(self, path, build, incomplete=None):
+        self.path = path
+        self._build = build
+        self._incomplete = incomplete
+        self._snapshot = None
+        # ('stored', version) or ('file', mtime) for what we last loaded.
+        self._version = None
+        self._next_check = 0
+        self._retry_at = None
+        self._retry_interval = _MIN_RETRY_INTERVAL.total_seconds()
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return the current snapshot, loading it if need be."""
+        if time.time() >= self._next_check:
+            self._check()
+        return self._snapshot
+
+    def reload(self):
+        """Rebuild the snapshot now, whether or not the file has changed."""
+        with self._lock:
+            self._load(force=True)
+        return self._snapshot
+
+    def _check(self):
+        # Only one thread needs to check; the rest carry on with what we have.
+        # Until we have something, though, everyone waits for it.
+        if not self._lock.acquire(self._snapshot is None):
+            return
+        try:
+            if time.time() >= self._next_check:
+                self._load(force=False)
+        finally:
+            self._lock.release()
+
+    def _load(self, force):
+        now = time.time()
+        self._next_check = now + _CHECK_INTERVAL.total_seconds()
+        try:
+            stored = _stored(self.path)
+        except Exception as e:
+            if self._snapshot is not None:
+                logging.warning("Unable to check for a new %s: %s"
+                                % (self.path, e))
+                return
+            # We'd rather start with the deployed file than not at all.
+            logging.warning("Unable to read the stored %s, so using the "
+                            "deployed one: %s" % (self.path, e))
+            stored = None
+        try:
+            if stored is not None:
+                version = ('stored', stored.version)
+            else:
+                version = ('file', os.path.getmtime(self.path))
+            retry_due = self._retry_at is not None and now >= self._retry_at
+            if (version == self._version and self._snapshot is not None and
+                    not force and not retry_due):
+                return
+            # We only try each version once, so a bad one doesn't fill the
+            # logs until it's fixed.
+            self._version = version
+            if stored is not None:
+                config = json.loads(stored.text)
+            else:
+                with open(self.path) as f:
+                    config = json.load(f)
+            snapshot = self._build(config, self._snapshot)
+        except Exception:
+            if self._snapshot is None:
+                raise
+            logging.exception("Unable to reload %s; keeping the old one"
+                              % self.path)
+            return
+        # Swapping in the new snapshot is a single assignment, so readers
+        # see either the old one or the new one.
+        self._snapshot = snapshot
+        logging.info("Loaded %s version %s" % (self.path, version))
+        self._schedule_retry(now)
+
+    def _schedule_retry(self, now):
+        if not (self._incomplete and self._incomplete(self._snapshot)):
+            self._retry_at = None
+            self._retry_interval = _MIN_RETRY_INTERVAL.total_seconds()
+            return
+        self._retry_at = now + self._retry_interval
+        logging.info("%s is incomplete; rebuilding in %ss"
+                     % (self.path, self._retry_interval))
+        self._retry_interval = min(self._retry_interval * 2,
+                                   _MAX_RETRY_INTERVAL.total_seconds())
@@ -0,0 +1,115 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import config_file
+
+
+class WatchedTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.addCleanup(self.testbed.deactivate)
+        ndb.get_context().clear_cache()
+        self.now = 1000.0
+        patcher = mock.patch('time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self.path = os.path.join(tempdir, 'routing.json')
+        self.mtime = 0
+        self._write({'version': 1})
+        self.builds = []
+        self.watched = config_file.Watched(self.path, self._build)
+
+    def _write(self, config):
+        with open(self.path, 'w') as f:
+            f.write(config if isinstance(config, str) else json.dumps(config))
+        self.mtime += 1
+        os.utime(self.path, (self.mtime, self.mtime))
+
+    def _build(self, config, previous):
+        self.builds.append((config, previous))
+        return config['version']
+
+    def test_reloads_when_file_changes(self):
+        self.assertEqual(self.watched.get(), 1)
+        self._write({'version': 2})
+        self.assertEqual(self.watched.get(), 1)
+        self.now += 5
+        self.assertEqual(self.watched.get(), 2)
+        self.assertEqual(self.builds[-1], ({'version': 2}, 1))
+
+    def test_unchanged_file_not_rebuilt(self):
+        self.watched.get()
+        self.now += 5
+        self.watched.get()
+        self.assertEqual(len(self.builds), 1)
+
+    def test_bad_file_keeps_old_snapshot(self):
+        self.watched.get()
+        self._write('{not json')
+        self.now += 5
+        self.assertEqual(self.watched.get(), 1)
+        self._write({'version': 3})
+        self.now += 5
+        self.assertEqual(self.watched.get(), 3)
+
+    def test_stored_config_used_instead_of_file(self):
+        self.assertEqual(self.watched.get(), 1)
+        self.assertEqual(
+            config_file.save(self.path, json.dumps({'version': 2})), 1)
+        self.now += 5
+        self.assertEqual(self.watched.get(), 2)
+        # Changes to the deployed file don't matter any more.
+        self._write({'version': 3})
+        self.now += 5
+        self.assertEqual(self.watched.get(), 2)
+        self.assertEqual(
+            config_file.save(self.path, json.dumps({'version': 4})), 2)
+        self.now += 5
+        self.assertEqual(self.watched.get(), 4)
+        self.assertEqual(config_file.current_text(self.path),
+                         json.dumps({'version': 4}))
+
+    def test_unreadable_datastore_keeps_old_snapshot(self):
+        self.watched.get()
+        config_file.save(self.path, json.dumps({'version': 2}))
+        with mock.patch('config_file._stored', side_effect=IOError('down')):
+            self.now += 5
+            self.assertEqual(self.watched.get(), 1)
+
+    def test_bad_file_on_first_load_raises(self):
+        self._write('{not json')
+        self.assertRaises(ValueError, self.watched.get)
+
+    def test_incomplete_snapshot_rebuilt_with_backoff(self):
+        watched = config_file.Watched(
+            self.path, self._build, incomplete=lambda version: version < 2)
+        watched.get()
+        self.now += 5
+        watched.get()
+        self.assertEqual(len(self.builds), 1)
+        self.now += 25
+        watched.get()
+        self.assertEqual(len(self.builds), 2)
+        # Still incomplete, so we wait twice as long next time.
+        self.now += 30
+        watched.get()
+        self.assertEqual(len(self.builds), 2)
+        self.now += 30
+        watched.get()
+        self.assertEqual(len(self.builds), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
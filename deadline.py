@@ -0,0 +1,132 @@
+"""A per-request time budget for outbound calls.
+
+App Engine kills a request when it hits its deadline, so if one Phabricator
+call hangs, every Slack post after it is lost.  To avoid that, each handler
+runs inside `started()`, and every outbound call asks `current().timeout()`
+how long it may take.  Calls that we can live without (looking up extra
+channels, author names) are held back from the last `reserve` seconds of the
+budget so that the Slack posts themselves always get time to go out.
+
+The deadline lives in a thread-local, since App Engine serves each request on
+its own thread; code that hands work to other threads must pass it along.
+"""
+import contextlib
+import functools
+import logging
+import threading
+import time
+
+
+# No single call gets longer than this, however much budget is left.
+_MAX_CALL_TIMEOUT = 10.0
+
+# Critical calls get at least this long, even if we're out of budget.
+_MIN_CRITICAL_TIMEOUT = 1.0
+
+
+class BudgetExhausted(Exception):
+    """Raised instead of making a non-critical call we have no time for."""
+    pass
+
+
+class Deadline(object):
+    def __init__(self, budget=None, reserve=0.0):
+        """A deadline `budget` seconds from now, or never if budget is None.
+
+        The last `reserve` seconds of the budget are only for critical calls.
+        """
+        self.started_at = time.time()
+        self.expires_at = (None if budget is None
+                           else self.started_at + budget)
+        self.reserve = reserve
+        # Map from stage name to total seconds spent in it.
+        self.stage_times = {}
+        self._stage_lock = threading.Lock()
+
+    def remaining(self):
+        if self.expires_at is None:
+            return float('inf')
+        return self.expires_at - time.time()
+
+    def timeout(self, critical=False):
+        """Return the timeout, in seconds, to use for an outbound call.
+
+        For non-critical calls, raises BudgetExhausted if only the reserve
+        is left.
+        """
+        if critical:
+            available = max(self.remaining(), _MIN_CRITICAL_TIMEOUT)
+        else:
+            available = self.remaining() - self.reserve
+            if available <= 0:
+                raise BudgetExhausted(
+                    "%.1fs left, all reserved for critical calls"
+                    % self.remaining())
+        return min(available, _MAX_CALL_TIMEOUT)
+
+    def can_afford(self, seconds):
+        """Whether optional work taking `seconds` fits outside the reserve."""
+        return self.remaining() - self.reserve >= seconds
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager to count the time spent inside it towards `name`.
+
+        Stages may be entered more than once; the times add up.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self._stage_lock:
+                self.stage_times[name] = (
+                    self.stage_times.get(name, 0) + time.time() - start)
+
+    def report(self):
+        logging.info("Request took %.3fs: %s" % (
+            time.time() - self.started_at,
+            ', '.join('%s %.3fs' % (name, seconds)
+                      for name, seconds in sorted(self.stage_times.items()))))
+
+
+_local = threading.local()
+
+# The deadline for code running outside any request, e.g. at import time.
+_NO_DEADLINE = Deadline()
+
+
+def current():
+    """Return the Deadline for the request running on this thread."""
+    return getattr(_local, 'deadline', None) or _NO_DEADLINE
+
+
+@contextlib.contextmanager
+def installed(deadline):
+    """Make `deadline` the current one on this thread while in this block."""
+    previous = getattr(_local, 'deadline', None)
+    _local.deadline = deadline
+    try:
+        yield deadline
+    finally:
+        _local.deadline = previous
+
+
+def timed(stage_name):
+    """Decorator to count every call of a function towards a stage."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with current().stage(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextlib.contextmanager
+def started(budget, reserve=0.0):
+    """Run a request handler under a fresh Deadline, and log its stages."""
+    with installed(Deadline(budget, reserve)) as deadline:
+        try:
+            yield deadline
+        finally:
+            deadline.report()
@@ -0,0 +1,59 @@
+import unittest
+
+import mock
+
+import deadline
+
+
+class DeadlineTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_timeout_is_capped(self):
+        d = deadline.Deadline(50, reserve=15)
+        self.assertEqual(d.timeout(), deadline._MAX_CALL_TIMEOUT)
+
+    def test_timeout_leaves_reserve(self):
+        d = deadline.Deadline(50, reserve=15)
+        self.now += 30
+        self.assertEqual(d.timeout(), 5)
+        self.assertEqual(d.timeout(critical=True), 10)
+
+    def test_reserve_only_for_critical_calls(self):
+        d = deadline.Deadline(50, reserve=15)
+        self.now += 40
+        self.assertRaises(deadline.BudgetExhausted, d.timeout)
+        self.assertEqual(d.timeout(critical=True), 10)
+        self.assertFalse(d.can_afford(1))
+
+    def test_critical_calls_always_get_some_time(self):
+        d = deadline.Deadline(50, reserve=15)
+        self.now += 60
+        self.assertEqual(d.timeout(critical=True),
+                         deadline._MIN_CRITICAL_TIMEOUT)
+
+    def test_no_deadline_outside_requests(self):
+        self.assertEqual(deadline.current().timeout(),
+                         deadline._MAX_CALL_TIMEOUT)
+        self.assertTrue(deadline.current().can_afford(3600))
+
+    def test_stages(self):
+        @deadline.timed('slow')
+        def slow_call():
+            self.now += 2
+
+        with deadline.started(50) as d:
+            self.assertIs(deadline.current(), d)
+            slow_call()
+            slow_call()
+            with d.stage('fast'):
+                pass
+        self.assertEqual(d.stage_times, {'slow': 4, 'fast': 0})
+        self.assertIsNot(deadline.current(), d)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+"""Drop repeats of Slack posts we've made recently.
+
+The same diff can come to us through both Phabricator feeds, and Phabricator
+retries deliveries it thinks failed, so we'd sometimes post the same message
+to the same channel twice in quick succession.  A Dedupe remembers a
+fingerprint of each (channel, message) it's seen for about `window` seconds,
+and tells us to skip any repeats.  Messages are compared after collapsing
+whitespace and case.
+
+Fingerprints are kept in a fixed ring of time buckets, each covering a slice
+of the window; a bucket is cleared when the ring comes back around to it, so
+nothing ever needs to be expired one at a time.  Each bucket holds at most
+`max_per_bucket` fingerprints, so memory is bounded however busy we are;
+beyond that we just stop deduping until the next bucket.
+"""
+import collections
+import hashlib
+import threading
+import time
+
+
+def _fingerprint(channel, message):
+    if isinstance(message, unicode):
+        message = message.encode('utf-8')
+    normalized = ' '.join(message.split()).lower()
+    return hashlib.sha1('%s\0%s' % (channel, normalized)).digest()[:8]
+
+
+class Dedupe(object):
+    def __init__(self, window, buckets=10, max_per_bucket=1000):
+        self._bucket_seconds = float(window) / buckets
+        self._max_per_bucket = max_per_bucket
+        # Each bucket is [bucket number, set of fingerprints], where bucket
+        # number n covers the time from n to n + 1 times _bucket_seconds.
+        self._buckets = [[None, set()] for _ in xrange(buckets)]
+        # Map from channel to how many posts to it we've suppressed.
+        self._suppressed = collections.Counter()
+        self._lock = threading.Lock()
+
+    def is_repeat(self, channel, message):
+        """Return True if we should skip posting `message` to `channel`.
+
+        If not, we remember it, so the next one will be; call forget() if
+        the post then fails.
+        """
+        fingerprint = _fingerprint(channel, message)
+        number = int(time.time() // self._bucket_seconds)
+        with self._lock:
+            for bucket_number, fingerprints in self._buckets:
+                if (bucket_number is not None and
+                        number - bucket_number < len(self._buckets) and
+                        fingerprint in fingerprints):
+                    self._suppressed[channel] += 1
+                    return True
+
+            bucket = self._buckets[number % len(self._buckets)]
+            if bucket[0] != number:
+                bucket[0] = number
+                bucket[1].clear()
+            if len(bucket[1]) < self._max_per_bucket:
+                bucket[1].add(fingerprint)
+            return False
+
+    def forget(self, channel, message):
+        """Forget we saw `message` in `channel`, say because posting it
+        failed, so that it isn't a repeat next time."""
+        fingerprint = _fingerprint(channel, message)
+        with self._lock:
+            for _, fingerprints in self._buckets:
+                fingerprints.discard(fingerprint)
+
+    def suppressed(self):
+        """Return a dict from channel to how many posts we've suppressed."""
+        with self._lock:
+            return dict(self._suppressed)
+
+    def size(self):
+        with self._lock:
+            return sum(len(fingerprints) for _, fingerprints in self._buckets)
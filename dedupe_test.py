@@ -0,0 +1,51 @@
+import unittest
+
+import mock
+
+import dedupe
+
+
+class DedupeTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.dedupe = dedupe.Dedupe(window=60, buckets=6, max_per_bucket=3)
+
+    def test_repeat_suppressed(self):
+        self.assertFalse(self.dedupe.is_repeat('#a', 'Hello  World'))
+        self.now += 30
+        self.assertTrue(self.dedupe.is_repeat('#a', u'hello world\n'))
+        self.assertFalse(self.dedupe.is_repeat('#b', 'hello world'))
+        self.assertEqual(self.dedupe.suppressed(), {'#a': 1})
+
+    def test_forget(self):
+        self.assertFalse(self.dedupe.is_repeat('#a', 'hello'))
+        self.dedupe.forget('#a', 'hello')
+        self.assertFalse(self.dedupe.is_repeat('#a', 'hello'))
+        self.assertTrue(self.dedupe.is_repeat('#a', 'hello'))
+
+    def test_repeat_after_window_posted(self):
+        self.assertFalse(self.dedupe.is_repeat('#a', 'hello'))
+        self.now += 60
+        self.assertFalse(self.dedupe.is_repeat('#a', 'hello'))
+
+    def test_bounded(self):
+        for i in xrange(10):
+            self.dedupe.is_repeat('#a', 'message %s' % i)
+        self.assertEqual(self.dedupe.size(), 3)
+        self.assertTrue(self.dedupe.is_repeat('#a', 'message 0'))
+        self.assertFalse(self.dedupe.is_repeat('#a', 'message 9'))
+
+    def test_old_buckets_cleared(self):
+        for i in xrange(6):
+            self.dedupe.is_repeat('#a', 'message %s' % i)
+            self.now += 10
+        self.assertEqual(self.dedupe.size(), 6)
+        self.dedupe.is_repeat('#a', 'message 6')
+        self.assertEqual(self.dedupe.size(), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
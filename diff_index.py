@@ -0,0 +1,106 @@
+"""A persistent index from Phabricator diff ID to repository.
+
+A diff's repository never changes, so once we've looked it up we never need
+to ask Phabricator about it again.  We keep the recently used part of the
+index in instance memory so routing a known diff is just a dict lookup, and
+write it through to the datastore, which holds all of it, so that a new
+instance doesn't have to start from scratch.  Instance memory only holds the
+_MAX_CACHED_DIFFS most recently used diffs, since a backfill can record
+every diff in Phabricator.
+
+The datastore is strictly a cache here: if it's unavailable we log and carry
+on, and the caller falls back to asking Phabricator.
+"""
+import collections
+import logging
+import threading
+
+from google.appengine.ext import ndb
+
+import memory
+
+
+class DiffRepository(ndb.Model):
+    """The repository for a single diff, keyed by the diff's numeric ID."""
+    repository_phid = ndb.StringProperty(indexed=False)
+    callsign = ndb.StringProperty(indexed=False)
+
+    # We keep our own copy in instance memory, so memcache wouldn't help.
+    _use_memcache = False
+
+
+# How many diffs to keep in instance memory.  Beyond that we drop the least
+# recently used; they're still in the datastore.
+_MAX_CACHED_DIFFS = 10000
+
+# Map from diff ID to (repository PHID, callsign), least recently used first.
+_index = collections.OrderedDict()
+_lock = threading.Lock()
+memory.register('diff_index', lambda: _index)
+
+
+def _remember(entries):
+    """Add a dict of entries to _index as the most recently used.
+
+    The caller must hold _lock.
+    """
+    for diff_id, entry in entries.items():
+        _index.pop(diff_id, None)
+        _index[diff_id] = entry
+    while len(_index) > _MAX_CACHED_DIFFS:
+        _index.popitem(last=False)
+
+
+def get(diff_id):
+    """Return (repository PHID, callsign) for a diff, or None if unknown."""
+    with _lock:
+        entry = _index.pop(diff_id, None)
+        if entry is not None:
+            _index[diff_id] = entry
+            return entry
+
+    try:
+        record = DiffRepository.get_by_id(diff_id)
+    except Exception:
+        logging.exception("Unable to read D%s from the diff index" % diff_id)
+        return None
+
+    if record is None:
+        return None
+    entry = (record.repository_phid, record.callsign)
+    with _lock:
+        _remember({diff_id: entry})
+    return entry
+
+
+def put(diff_id, repository_phid, callsign):
+    put_many({diff_id: (repository_phid, callsign)})
+
+
+def put_many(entries):
+    """Record a dict from diff ID to (repository PHID, callsign).
+
+    Entries we already know about aren't written again.
+    """
+    with _lock:
+        new_entries = {diff_id: entry for diff_id, entry in entries.items()
+                       if _index.get(diff_id) != entry}
+        _remember(new_entries)
+
+    if not new_entries:
+        return
+
+    try:
+        ndb.put_multi([
+            DiffRepository(id=diff_id, repository_phid=repository_phid,
+                           callsign=callsign)
+            for diff_id, (repository_phid, callsign)
+            in new_entries.items()])
+    except Exception:
+        logging.exception("Unable to persist %s diff index entries"
+                          % len(new_entries))
+
+
+def size():
+    """Return how many diffs we have in instance memory."""
+    return len(_index)
@@ -0,0 +1,48 @@
+import unittest
+
+import mock
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import diff_index
+
+
+class DiffIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.addCleanup(self.testbed.deactivate)
+        ndb.get_context().clear_cache()
+        diff_index._index.clear()
+        self.addCleanup(diff_index._index.clear)
+
+    def test_unknown_diff(self):
+        self.assertIsNone(diff_index.get(123))
+
+    def test_put_and_get(self):
+        diff_index.put(123, 'PHID-REPO-1', 'GWA')
+        self.assertEqual(diff_index.get(123), ('PHID-REPO-1', 'GWA'))
+
+    def test_survives_losing_instance_memory(self):
+        diff_index.put_many({123: ('PHID-REPO-1', 'GWA'),
+                             456: ('PHID-REPO-2', 'GI')})
+        diff_index._index.clear()
+        self.assertEqual(diff_index.get(456), ('PHID-REPO-2', 'GI'))
+        self.assertEqual(diff_index.size(), 1)
+
+    def test_least_recently_used_dropped_from_memory(self):
+        with mock.patch('diff_index._MAX_CACHED_DIFFS', 2):
+            diff_index.put(1, 'PHID-REPO-1', 'GWA')
+            diff_index.put(2, 'PHID-REPO-2', 'GI')
+            diff_index.get(1)
+            diff_index.put(3, 'PHID-REPO-3', 'GP')
+            self.assertEqual(list(diff_index._index), [1, 3])
+            # It's still in the datastore, though.
+            self.assertEqual(diff_index.get(2), ('PHID-REPO-2', 'GI'))
+            self.assertEqual(list(diff_index._index), [3, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
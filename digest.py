@@ -0,0 +1,155 @@
+"""Collect messages per channel and post them together.
+
+When lots of diffs are created at once, posting each one separately runs into
+Slack's per-channel rate limit.  A Digest instead holds on to each channel's
+messages for a short window and then posts them as one multi-line message, so
+the number of posts depends on how many channels are busy, not on how busy
+they are.  A channel is flushed early if it collects `max_size` messages.
+
+If a post fails, we put its messages back and try again later, backing off
+exponentially; if `send` raises RetryLater (say, because Slack answered 429),
+we wait at least as long as it asks.  We give up after _MAX_ATTEMPTS.
+
+Posts usually go out from a background thread, long after the requests that
+added the messages have finished, so each message carries the trace span it
+was added under (see tracing.py).  A post is recorded as a span in the trace
+of its oldest traced message, with the other traces it covers as an
+attribute.
+"""
+import contextlib
+import logging
+import threading
+import time
+
+import tracing
+
+
+# How long to wait before retrying a failed post the first time; we double it
+# for each later attempt.
+_RETRY_DELAY = 5
+_MAX_ATTEMPTS = 5
+
+
+class RetryLater(Exception):
+    """Raised by `send` when it's been asked to slow down.
+
+    `seconds` is how long we were asked to wait, if we were told.
+    """
+    def __init__(self, message, seconds=None):
+        super(RetryLater, self).__init__(message)
+        self.seconds = seconds
+
+
+@contextlib.contextmanager
+def _traced_post(channel, messages, spans):
+    """Record a span for posting `messages`, which were added under `spans`,
+    in the trace of the first of them that was traced."""
+    traced = [span for span in spans if span is not None]
+    if not traced:
+        yield
+        return
+    linked_traces = set(span.trace_id for span in traced)
+    linked_traces.discard(traced[0].trace_id)
+    with tracing.installed(traced[0]), \
+            tracing.span('digest.post', channel=channel,
+                         messages=len(messages),
+                         linked_traces=sorted(linked_traces)):
+        yield
+
+
+class Digest(object):
+    def __init__(self, send, window, max_size, start_thread,
+                 on_failure=None):
+        """`send(channel, text)` posts a message.
+
+        `start_thread(func)` runs func on a thread that can outlive the
+        request, which we do on the first add() to flush messages once their
+        window is up.  If we give up on a post, we call `on_failure(channel,
+        messages)` with the messages it was for, if given.
+        """
+        self._send = send
+        self._on_failure = on_failure
+        self._window = window
+        self._max_size = max_size
+        self._start_thread = start_thread
+        self._started = False
+        # Map from channel to (time to post it, list of messages, list of
+        # the span each message was added under, number of failed posts).
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def add(self, channel, message):
+        with self._lock:
+            if not self._started:
+                self._started = True
+                self._start_thread(self._flush_forever)
+            _, messages, spans, attempts = self._pending.setdefault(
+                channel, (time.time() + self._window, [], [], 0))
+            messages.append(message)
+            spans.append(tracing.current_span())
+            # If we're backing off, a full channel waits like the rest.
+            if len(messages) >= self._max_size and not attempts:
+                batches = [(channel,) + self._pending.pop(channel)[1:]]
+            else:
+                batches = []
+        self._send_batches(batches)
+
+    def flush(self, due_only=False):
+        """Post everything we're holding on to.
+
+        If `due_only` is set, only post for channels whose window is up.
+        """
+        now = time.time()
+        with self._lock:
+            channels = [channel for channel, (due, _, _, _)
+                        in self._pending.items()
+                        if not due_only or due <= now]
+            batches = [(channel,) + self._pending.pop(channel)[1:]
+                       for channel in channels]
+        self._send_batches(batches)
+
+    def _send_batches(self, batches):
+        for channel, messages, spans, attempts in batches:
+            try:
+                with _traced_post(channel, messages, spans):
+                    self._send(channel, '\n'.join(messages))
+            except Exception as e:
+                logging.exception("Unable to post %s messages to %s"
+                                  % (len(messages), channel))
+                attempts += 1
+                if attempts < _MAX_ATTEMPTS:
+                    delay = _RETRY_DELAY * 2 ** (attempts - 1)
+                    if isinstance(e, RetryLater) and e.seconds:
+                        delay = max(delay, e.seconds)
+                    self._requeue(channel, messages, spans, attempts, delay)
+                elif self._on_failure is not None:
+                    self._on_failure(channel, messages)
+
+    def _requeue(self, channel, messages, spans, attempts, delay):
+        """Put back messages whose post failed, ahead of any that were added
+        since, to try again in `delay` seconds."""
+        logging.info("Retrying %s messages to %s in %ss"
+                     % (len(messages), channel, delay))
+        with self._lock:
+            _, added, added_spans, _ = self._pending.pop(
+                channel, (None, [], [], 0))
+            self._pending[channel] = (time.time() + delay,
+                                      messages + added, spans + added_spans,
+                                      attempts)
+
+    def _seconds_until_due(self):
+        with self._lock:
+            if not self._pending:
+                return self._window
+            due = min(due for due, _, _, _ in self._pending.values())
+        return max(0, due - time.time())
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(self._seconds_until_due())
+            self.flush(due_only=True)
+
+    def size(self):
+        with self._lock:
+            return sum(len(messages)
+                       for _, messages, _, _ in self._pending.values())
@@ -0,0 +1,132 @@
+import unittest
+
+import mock
+
+import digest
+import tracing
+
+
+class DigestTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.sent = []
+        self.start_thread = mock.Mock()
+        self.digest = digest.Digest(
+            lambda channel, text: self.sent.append((channel, text)),
+            window=30, max_size=3, start_thread=self.start_thread)
+
+    def test_batches_per_channel(self):
+        self.digest.add('#a', 'one')
+        self.digest.add('#b', 'two')
+        self.digest.add('#a', 'three')
+        self.assertEqual(self.sent, [])
+        self.now += 30
+        self.digest.flush(due_only=True)
+        self.assertEqual(sorted(self.sent),
+                         [('#a', 'one\nthree'), ('#b', 'two')])
+        self.assertEqual(self.digest.size(), 0)
+        self.assertEqual(self.start_thread.call_count, 1)
+
+    def test_only_due_channels_flushed(self):
+        self.digest.add('#a', 'one')
+        self.now += 20
+        self.digest.add('#b', 'two')
+        self.now += 10
+        self.digest.flush(due_only=True)
+        self.assertEqual(self.sent, [('#a', 'one')])
+        self.assertEqual(self.digest._seconds_until_due(), 20)
+
+    def test_flushes_when_full(self):
+        for message in ('one', 'two', 'three'):
+            self.digest.add('#a', message)
+        self.assertEqual(self.sent, [('#a', 'one\ntwo\nthree')])
+
+    def test_flush_everything(self):
+        self.digest.add('#a', 'one')
+        self.digest.flush()
+        self.assertEqual(self.sent, [('#a', 'one')])
+
+    def test_send_failures_dont_block_other_channels(self):
+        send = mock.Mock(side_effect=[IOError('Slack is down'), None])
+        d = digest.Digest(send, window=30, max_size=3,
+                          start_thread=mock.Mock())
+        d.add('#a', 'one')
+        d.add('#b', 'two')
+        d.flush()
+        self.assertEqual(send.call_count, 2)
+
+    def test_failures_reported(self):
+        on_failure = mock.Mock()
+        d = digest.Digest(mock.Mock(side_effect=IOError('Slack is down')),
+                          window=30, max_size=3, start_thread=mock.Mock(),
+                          on_failure=on_failure)
+        d.add('#a', 'one')
+        d.add('#a', 'two')
+        for _ in xrange(digest._MAX_ATTEMPTS):
+            self.assertEqual(on_failure.call_count, 0)
+            d.flush()
+        on_failure.assert_called_once_with('#a', ['one', 'two'])
+        self.assertEqual(d.size(), 0)
+
+    def test_failed_post_retried_with_backoff(self):
+        send = mock.Mock(side_effect=[IOError('Slack is down'),
+                                      IOError('Slack is down'), None])
+        d = digest.Digest(send, window=30, max_size=3,
+                          start_thread=mock.Mock())
+        d.add('#a', 'one')
+        self.now += 30
+        d.flush(due_only=True)
+        d.add('#a', 'two')
+        self.assertEqual(d._seconds_until_due(), digest._RETRY_DELAY)
+        self.now += digest._RETRY_DELAY
+        d.flush(due_only=True)
+        self.assertEqual(d._seconds_until_due(), 2 * digest._RETRY_DELAY)
+        # Filling up doesn't skip the backoff.
+        d.add('#a', 'three')
+        self.assertEqual(send.call_count, 2)
+        self.now += 2 * digest._RETRY_DELAY
+        d.flush(due_only=True)
+        self.assertEqual(send.call_args[0], ('#a', 'one\ntwo\nthree'))
+        self.assertEqual(d.size(), 0)
+
+    def test_rate_limit_waits_as_asked(self):
+        send = mock.Mock(side_effect=[digest.RetryLater('429', seconds=60),
+                                      None])
+        d = digest.Digest(send, window=30, max_size=3,
+                          start_thread=mock.Mock())
+        d.add('#a', 'one')
+        d.flush()
+        self.assertEqual(d._seconds_until_due(), 60)
+        self.now += 59
+        d.flush(due_only=True)
+        self.assertEqual(send.call_count, 1)
+        self.now += 1
+        d.flush(due_only=True)
+        self.assertEqual(send.call_count, 2)
+
+    def test_post_traced_under_first_message(self):
+        exported = []
+        for patcher in [mock.patch('tracing._exporter', exported.extend),
+                        mock.patch('tracing._SAMPLE_RATE', 1)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        with tracing.trace('first') as first:
+            self.digest.add('#a', 'one')
+        with tracing.trace('second') as second:
+            self.digest.add('#a', 'two')
+        self.digest.add('#a', 'three')
+        tracing.export()
+        post = [span for span in exported if span['name'] == 'digest.post']
+        self.assertEqual(len(post), 1)
+        self.assertEqual(post[0]['trace_id'], first.trace_id)
+        self.assertEqual(post[0]['parent_id'], first.span_id)
+        self.assertEqual(post[0]['attributes'], {
+            'channel': '#a', 'messages': 3,
+            'linked_traces': [second.trace_id]})
+
+
+if __name__ == '__main__':
+    unittest.main()
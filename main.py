@@ -1,12 +1,28 @@
 # TODO(colin): fix these lint errors (http://pep8.readthedocs.io/en/release-1.7.x/intro.html#error-codes)
 # pep8-disable:E124,E128
+import atexit
+import collections
+import datetime
 import json
 import logging
+import os
 import re
 import sys
-
+import threading
+import time
+
+import config_file
+import deadline
+import dedupe
+import diff_index
+import digest
+import memory
 import pager_parrot
+import parallel
 import phabricator_fox
+import profiler
+import tracing
+import user_index
 import webapp2
 
 try:
@@ -28,19 +44,36 @@ from third_party import requests
 # it's not the end of the world.  In fact, Kamens thinks it's a very parrot-y
 # thing to do.
 pagerduty_ids_seen = set()
+memory.register('main.pagerduty_ids_seen', lambda: pagerduty_ids_seen)
 
 PHABRICATOR_HOST = "https://phabricator.khanacademy.org"
 PHABRICATOR_USERNAME = "khan-webhooks"
 
+# App Engine gives each request 60 seconds; we budget a bit less than that for
+# outbound calls, and hold the last part of it back for Slack posts.  See
+# deadline.py.
+_REQUEST_BUDGET = datetime.timedelta(seconds=50)
+_CRITICAL_RESERVE = datetime.timedelta(seconds=15)
+
+# We skip optional lookups (like author names we don't already know) unless
+# there's at least this much non-reserved budget left.
+_OPTIONAL_CALL_BUDGET = datetime.timedelta(seconds=5)
+
 
-def _get_phabricator():
+def _get_phabricator(critical=False):
+    """Return a conduit client whose calls time out with our budget.
+
+    Pass `critical` for calls we can't post without; see deadline.py.
+    """
     return phabricator.Phabricator(
         host=PHABRICATOR_HOST + '/api/',
         username=PHABRICATOR_USERNAME,
         certificate=secrets.phabricator_certificate,
+        timeout=deadline.current().timeout(critical=critical),
     )
 
 
+@tracing.traced('conduit.repository.query')
 def _callsigns_from_repo_urls(repo_urls):
     """Given a list of possible repo URLs, return a set of all callsigns that
     correspond to them.
@@ -54,86 +87,73 @@ def _callsigns_from_repo_urls(repo_urls):
     return set(repo['callsign'] for repo in resp)
 
 
-# The following is a list of Khan GitHub repositories to interested Slack
-# channels. These channels will be notified, in addition to #1s-and-0s,
-# when interesting activity happens. You do not need the initial "Khan/".
-GITHUB_CHANNEL_MAP = {
-    'iOS': {'#mobile-1s-and-0s'},
-    'android': {'#mobile-1s-and-0s'},
-    'mobile': {'#mobile-1s-and-0s'},
-    'mobile-client-webview-resources': {'#mobile-1s-and-0s'},
-    'hivemind': {'#long-term-research'},
-    'Cantor': {'#long-term-research'},
-    'slacker-cow': {'#hipslack'},
-    'jenkins-jobs': {'#hipslack'},
-    'culture-cow': {'#hipslack'},
-    'khan-webhooks': {'#hipslack'},
-
-    # Content tools repositories
-    'content-tools-tools': {'#content-tools'},
-    'graphie-to-png': {'#content-tools'},
-    'KAS': {'#content-tools'},
-    'KaTeX': {'#content-tools'},
-    'khan-exercises': {'#content-tools'},
-    'mathquill': {'#content-tools'},
-    'perseus': {'#content-tools', '#mobile-1s-and-0s'},
-    'perseus-one': {'#content-tools'},
-    'react-native-shared': {'#mobile-1s-and-0s'},
-    'RCSS': {'#content-tools'},
-    'react-components': {'#content-tools'},
-    'simple-markdown': {'#content-tools'},
-    'kmath': {'#content-tools'},
-}
-
-
-USER_CHANNEL_MAP = {
-    'abdulrahman': {'#il-eng'},
-    'alice': {'#classroom-eng'},
-    'briangenisio': {'#il-eng'},
-    'bryan': {'#il-eng'},
-    'dhruv': {'#classroom-eng'},
-    'hannah': {'#il-eng'},
-    'hunter': {'#classroom-eng'},
-    'jared': {'#il-eng'},
-    'jenniferbandelin': {'#khan-district-eng'},
-    'kevinb': {'#il-eng'},
-    'kphilip': {'#khan-district-eng'},
-    'miguel': {'#classroom-eng'},
-    'mita': {'#classroom-eng'},
-    'nrowe': {'#il-eng'},
-    'reid': {'#classroom-eng'},
-    'sean': {'#classroom-eng'},
-    'steve': {'#khan-district-eng'},
-    'yash': {'#classroom-eng'},
-    'pepper': {'#classroom-eng'},
-}
-
 ACTIONS_MAP = {
     'create': 'created',
     'abandon': 'abandoned'
 }
 
 
-# Phabricator only gives us callsigns, so map these once and be done with it.
-CALLSIGN_CHANNEL_MAP = {}
-
-
-# Use my favorite old scary Python hack to make this a run-one initializer
-def _initialize_callsign_map(initialized=[False]):
-    if not initialized[0]:
-        initialized[0] = True
-        for repo, channels in GITHUB_CHANNEL_MAP.viewitems():
-            for callsign in _callsigns_from_repo_urls(
-                    ['git@github.com:Khan/%s' % repo]):
-                CALLSIGN_CHANNEL_MAP[callsign] = channels
-
-        # Need the extra parens on this next line, or you'll get just the key
-        logging.info('Channel map: %r' % (CALLSIGN_CHANNEL_MAP,))
-
+# Which channels hear about what, besides #1s-and-0s-commits.  These come
+# from routing.json:
+# - github_channels: map from Khan GitHub repository (you do not need the
+#   initial "Khan/") to interested Slack channels.
+# - user_channels: map from Phabricator username to interested Slack channels.
+# Phabricator only gives us callsigns, so we also keep the callsigns for each
+# repo, and a map from callsign to channels.
+Routing = collections.namedtuple('Routing', [
+    'github_channels', 'user_channels', 'repo_callsigns',
+    'callsign_channels'])
 
-_initialize_callsign_map()
 
+def _build_routing(config, previous):
+    """Build our Routing from the parsed routing.json.
 
+    We only look up callsigns for repos we haven't already; repos whose
+    lookup failed last time are tried again.  After one lookup fails we don't
+    try any more this time, since Phabricator is probably down and each try
+    would use up some of the budget of the request that's doing this.
+    """
+    github_channels = {repo: frozenset(channels) for repo, channels
+                       in config['github_channels'].iteritems()}
+    user_channels = {user: frozenset(channels) for user, channels
+                     in config['user_channels'].iteritems()}
+
+    known_callsigns = previous.repo_callsigns if previous else {}
+    repo_callsigns = {}
+    lookups_failing = False
+    for repo in github_channels:
+        if repo in known_callsigns:
+            repo_callsigns[repo] = known_callsigns[repo]
+            continue
+        if lookups_failing:
+            continue
+        try:
+            repo_callsigns[repo] = frozenset(_callsigns_from_repo_urls(
+                ['git@github.com:Khan/%s' % repo]))
+        except Exception:
+            logging.exception("Unable to get callsigns for %s" % repo)
+            lookups_failing = True
+
+    callsign_channels = {}
+    for repo, callsigns in repo_callsigns.iteritems():
+        for callsign in callsigns:
+            callsign_channels[callsign] = github_channels[repo]
+
+    # Need the extra parens on this next line, or you'll get just the key
+    logging.info('Channel map: %r' % (callsign_channels,))
+    return Routing(github_channels, user_channels, repo_callsigns,
+                   callsign_channels)
+
+
+_routing = config_file.Watched(
+    config_file.PATH, _build_routing,
+    incomplete=lambda routing: (
+        len(routing.repo_callsigns) < len(routing.github_channels)))
+memory.register('main.routing', lambda: _routing)
+
+
+@parallel.hedged('differential.query')
+@tracing.traced('conduit.differential.query')
 def _repository_phid_from_diff_id(diff_id):
     phab = _get_phabricator()
     resp = phab.phid.differential.query(ids=[diff_id]).response
@@ -141,6 +161,8 @@ def _repository_phid_from_diff_id(diff_id):
         return resp[0]['repositoryPHID']
 
 
+@parallel.hedged('repository.query')
+@tracing.traced('conduit.repository.query')
 def _callsign_from_repository_phid(phid):
     """Given a repository's PHID, return its callsign. Returns None if the
     repository can't be found.
@@ -155,15 +177,221 @@ def _callsign_from_repository_phid(phid):
         return resp[0]['callsign']
 
 
-def _transaction_search_from_phids(phid, phid_map):
+# How many transactions to ask for per page of `transaction.search`.  Webhook
+# deliveries only name a handful of transactions, so one page is almost
+# always enough.
+_TRANSACTION_PAGE_SIZE = 20
+
+
+@tracing.traced('conduit.repository.query')
+def _callsigns_from_repository_phids(phids):
+    """Like _callsign_from_repository_phid, but for many repositories at once.
+
+    Returns a dict from PHID to callsign, omitting repositories that can't be
+    found.
+    """
+    phab = _get_phabricator()
+    resp = phab.phid.repository.query(phids=list(phids)).response
+    return {repo['phid']: repo['callsign'] for repo in resp or []}
+
+
+# Our Phabricator lookups are shared with tasklet_engine.py, which makes its
+# outbound calls as tasklets rather than blocking.  So that both run the same
+# logic, it's written as "step" generators: a step generator yields a
+# _StepCall for each outbound call it needs, and is sent back the result (or
+# has the exception thrown into it).  Anything else it yields is one of its
+# outputs.
+# _run_steps() makes the calls with the functions in _STEP_CALLS.
+class _StepCall(object):
+    def __init__(self, name, *args):
+        self.name = name
+        self.args = args
+
+
+# Map from each call a step generator may ask for to the function that makes
+# it; tasklet_engine.py has a tasklet for each.
+_STEP_CALLS = {
+    'transactions': lambda phid, phid_map, after:
+        _transaction_search_from_phids(phid, phid_map, after=after),
+    'repository-phid': lambda diff_id: _repository_phid_from_diff_id(diff_id),
+    'callsign': lambda repo_phid: _callsign_from_repository_phid(repo_phid),
+    'phid-query': lambda phid: _phid_query_from_phid(phid),
+    'diff-callsign': lambda diff_id: _callsign_from_diff_id(diff_id),
+}
+
+
+def _run_steps(steps):
+    """Run a step generator, making each call it asks for as it comes, and
+    yield its outputs."""
+    value = exc_info = None
+    while True:
+        if exc_info:
+            step = steps.throw(*exc_info)
+        else:
+            step = steps.send(value)
+        value = exc_info = None
+        if not isinstance(step, _StepCall):
+            yield step
+            continue
+        try:
+            value = _STEP_CALLS[step.name](*step.args)
+        except Exception:
+            exc_info = sys.exc_info()
+
+
+def _step_result(steps):
+    """Run a step generator with a single output, and return it."""
+    return next(_run_steps(steps), None)
+
+
+def _callsign_steps(diff_id):
+    """Step generator for _callsign_from_diff_id."""
+    entry = diff_index.get(diff_id)
+    if entry is not None:
+        yield entry[1]
+        return
+
+    try:
+        repo_phid = yield _StepCall('repository-phid', diff_id)
+        repo_callsign = None
+        if repo_phid:
+            repo_callsign = yield _StepCall('callsign', repo_phid)
+    except deadline.BudgetExhausted as e:
+        logging.warning("Not looking up the repo for D%s: %s" % (diff_id, e))
+        yield None
+        return
+    if not repo_phid:
+        yield None
+        return
+    if not repo_callsign:
+        logging.info("Unable to get repo callsign for %s" % repo_phid)
+        yield None
+        return
+    diff_index.put(diff_id, repo_phid, repo_callsign)
+    yield repo_callsign
+
+
+@deadline.timed('routing')
+@tracing.traced('routing')
+def _callsign_from_diff_id(diff_id):
+    """Return the callsign of the repository a diff is against, or None.
+
+    Diffs never change repository, so we consult diff_index first and only
+    ask Phabricator (and record the answer) for diffs we haven't seen.
+    """
+    return _step_result(_callsign_steps(diff_id))
+
+
+# How many diffs to ask for per page of `differential.query` when backfilling
+# the diff index.
+_BACKFILL_PAGE_SIZE = 500
+
+
+def _backfill_diff_index(offset=0, max_pages=None):
+    """Record the repository of every diff in Phabricator in diff_index.
+
+    Diffs are fetched a page at a time, newest first, starting `offset` diffs
+    in; each page costs one `differential.query` and one `repository.query`.
+    Returns the offset to resume from, or None if we reached the end.
+    """
+    phab = _get_phabricator()
+    pages = 0
+    while max_pages is None or pages < max_pages:
+        diffs = phab.phid.differential.query(
+            limit=_BACKFILL_PAGE_SIZE, offset=offset).response
+        if not diffs:
+            return None
+
+        repo_phids = set(d['repositoryPHID'] for d in diffs
+                         if d.get('repositoryPHID'))
+        callsigns = (_callsigns_from_repository_phids(repo_phids)
+                     if repo_phids else {})
+        diff_index.put_many({
+            int(d['id']): (d['repositoryPHID'],
+                           callsigns[d['repositoryPHID']])
+            for d in diffs if d.get('repositoryPHID') in callsigns})
+
+        offset += len(diffs)
+        pages += 1
+        if len(diffs) < _BACKFILL_PAGE_SIZE:
+            return None
+    return offset
+
+
+@deadline.timed('transactions')
+@tracing.traced('conduit.transaction.search')
+def _transaction_search_from_phids(phid, phid_map, after=None):
+    """Fetch one page of the given transactions on the object `phid`.
+
+    `after` is the cursor returned with the previous page, if any.
+    """
     phab = _get_phabricator()
     return phab.phid.transaction.search(
-        objectIdentifier=phid, constraints=phid_map).response
+        **_transaction_search_params(phid, phid_map, after)).response
 
 
-def _send_to_slack(message, channel, username, icon_emoji, thread=None):
-    logging.info('Posting "%s" to %s in Slack' % (message, channel))
-    post_data = {
+def _transaction_search_params(phid, phid_map, after=None):
+    """Return the parameters for one page of `transaction.search`."""
+    params = {
+        'objectIdentifier': phid,
+        'constraints': phid_map,
+        'limit': _TRANSACTION_PAGE_SIZE,
+    }
+    if after:
+        params['after'] = after
+    return params
+
+
+def _transaction_steps(phid, phid_map, first_page, types):
+    """Step generator for _iter_transactions."""
+    unseen = set(phid_map['phids'])
+    page = first_page
+    while page:
+        for transaction in page['data']:
+            unseen.discard(transaction.get('phid'))
+            trans_type = transaction.get('type')
+            if trans_type not in types:
+                logging.info(
+                    "Transaction %s not a match. Skipping!" % trans_type)
+                continue
+            yield transaction
+
+        after = (page.get('cursor') or {}).get('after')
+        if not unseen or not after:
+            return
+        try:
+            page = yield _StepCall('transactions', phid, phid_map, after)
+        except deadline.BudgetExhausted as e:
+            logging.warning("Not fetching more transactions on %s: %s"
+                            % (phid, e))
+            return
+
+
+def _iter_transactions(phid, phid_map, first_page, types):
+    """Yield the transactions on `phid` whose type is in `types`.
+
+    `first_page` is the already-fetched first page of
+    `_transaction_search_from_phids(phid, phid_map)`.  Later pages are only
+    fetched (by following the `cursor`) once the caller has consumed the
+    earlier ones, and we stop paging as soon as we've seen every transaction
+    named in `phid_map`, even if Phabricator says there is more.
+    """
+    return _run_steps(_transaction_steps(phid, phid_map, first_page, types))
+
+
+# We talk to Slack a lot, so we keep the connection open between requests.
+_slack_session = requests.Session()
+
+
+def _slack_headers():
+    return {
+        'Content-type': 'application/json',
+        'Authorization': 'Bearer %s' % secrets.slack_bot_access_token,
+    }
+
+
+def _slack_post_data(message, channel, username, icon_emoji, thread=None):
+    return {
         'text': message,
         'channel': channel,
         'username': username,
@@ -171,12 +399,179 @@ def _send_to_slack(message, channel, username, icon_emoji, thread=None):
         'link_names': 1,
         'thread_ts': thread,
     }
-    return requests.post('https://slack.com/api/chat.postMessage',
-                         data=json.dumps(post_data),
-                         headers={
-                             'Content-type': 'application/json',
-                             'Authorization': 'Bearer %s' % (
-                                 secrets.slack_bot_access_token)})
+
+
+# We skip posting a message to a channel if we've posted the same thing there
+# within this long; see dedupe.py.  Set it to None to post everything.
+_SLACK_DEDUPE_WINDOW = datetime.timedelta(minutes=10)
+
+# This is None if we don't dedupe.
+_slack_dedupe = None
+if _SLACK_DEDUPE_WINDOW is not None:
+    _slack_dedupe = dedupe.Dedupe(_SLACK_DEDUPE_WINDOW.total_seconds())
+    memory.register('main.slack_dedupe', lambda: _slack_dedupe)
+
+
+def _is_repeat(message, channel):
+    """Return True, and log it, if we shouldn't post this message again."""
+    if _slack_dedupe is None:
+        return False
+    if not _slack_dedupe.is_repeat(channel, message):
+        return False
+    logging.info('Not posting "%s" to %s again (%s repeats suppressed there)'
+                 % (message, channel, _slack_dedupe.suppressed()[channel]))
+    return True
+
+
+def _forget_post(message, channel):
+    """Undo _is_repeat() for a message we then failed to post."""
+    if _slack_dedupe is not None:
+        _slack_dedupe.forget(channel, message)
+
+
+def _slack_accepted(resp):
+    """Whether a Slack API response says the call worked."""
+    try:
+        return bool(resp.json().get('ok'))
+    except ValueError:
+        return False
+
+
+@deadline.timed('slack')
+@tracing.traced('slack.chat.postMessage')
+def _send_to_slack(message, channel, username, icon_emoji, thread=None,
+                   check_repeats=True):
+    """Post a message to Slack, and return the response.
+
+    If we've posted it to this channel recently, we skip it and return None,
+    unless `check_repeats` is False.
+    """
+    if check_repeats and _is_repeat(message, channel):
+        return None
+    logging.info('Posting "%s" to %s in Slack' % (message, channel))
+    post_data = _slack_post_data(message, channel, username, icon_emoji,
+                                 thread)
+    try:
+        resp = _slack_session.post('https://slack.com/api/chat.postMessage',
+                                   data=json.dumps(post_data),
+                                   headers=_slack_headers(),
+                                   timeout=deadline.current().timeout(
+                                       critical=True))
+    except Exception:
+        if check_repeats:
+            _forget_post(message, channel)
+        raise
+    if check_repeats and not _slack_accepted(resp):
+        _forget_post(message, channel)
+    return resp
+
+
+def _send_fox_digest(channel, text):
+    resp = _send_to_slack(text, channel, 'Phabricator Fox', ':fox:',
+                          check_repeats=False)
+    if resp.status_code == 429:
+        retry_after = resp.headers.get('Retry-After')
+        raise digest.RetryLater(
+            "Slack rate-limited our post to %s" % channel,
+            seconds=float(retry_after) if retry_after else None)
+    if not _slack_accepted(resp):
+        raise RuntimeError("Slack didn't accept our post to %s: %s"
+                           % (channel, resp.text))
+
+
+def _forget_fox_digest(channel, messages):
+    for message in messages:
+        _forget_post(message, channel)
+
+
+@deadline.timed('slack')
+@tracing.traced('slack.chat.update')
+def _update_slack_message(message, channel_id, ts):
+    """Replace the text of a message we posted earlier."""
+    logging.info('Updating %s in %s to "%s"' % (ts, channel_id, message))
+    post_data = {
+        'text': message,
+        'channel': channel_id,
+        'ts': ts,
+        'link_names': 1,
+    }
+    return _slack_session.post('https://slack.com/api/chat.update',
+                               data=json.dumps(post_data),
+                               headers=_slack_headers(),
+                               timeout=deadline.current().timeout(
+                                   critical=True))
+
+
+def _start_background_thread(func):
+    """Run func on a thread that may outlive the current request."""
+    if os.environ.get('SERVER_SOFTWARE', '').startswith('Google App Engine'):
+        # Late import so we can run elsewhere; this needs manual scaling.
+        from google.appengine.api import background_thread
+        background_thread.start_new_background_thread(func, [])
+    else:
+        thread = threading.Thread(target=func)
+        thread.daemon = True
+        thread.start()
+
+
+# Phabricator Fox messages are collected per channel for this long and then
+# posted together, so a busy hour doesn't hit Slack's rate limits.  A channel
+# is posted to early once it has collected _FOX_DIGEST_MAX_MESSAGES.  Set the
+# window to None to post every message right away.
+_FOX_DIGEST_WINDOW = datetime.timedelta(seconds=30)
+_FOX_DIGEST_MAX_MESSAGES = 10
+
+# Fox messages are deduped before they go into the digest, since a digest
+# post as a whole won't repeat; if we give up on the post, we forget them
+# again.
+# This is None if we post every message right away.
+_fox_digest = None
+if _FOX_DIGEST_WINDOW is not None:
+    _fox_digest = digest.Digest(
+        _send_fox_digest,
+        window=_FOX_DIGEST_WINDOW.total_seconds(),
+        max_size=_FOX_DIGEST_MAX_MESSAGES,
+        start_thread=_start_background_thread,
+        on_failure=_forget_fox_digest)
+    memory.register('main.fox_digest', lambda: _fox_digest)
+
+
+def _flush_fox_digest():
+    """Post everything the Fox digest is holding on to now."""
+    if _fox_digest is not None:
+        _fox_digest.flush()
+
+
+# Don't lose what we're holding on to if the server exits.  (On App Engine,
+# we get a request to /_ah/stop instead.)
+atexit.register(_flush_fox_digest)
+atexit.register(tracing.export)
+
+# Set this in the environment to write trace spans to a file, instead of to
+# the log.
+if os.environ.get('KHAN_WEBHOOKS_TRACE_FILE'):
+    tracing.set_exporter(
+        tracing.FileExporter(os.environ['KHAN_WEBHOOKS_TRACE_FILE']))
+
+
+def _send_fox_message(message, channel):
+    if _fox_digest is None:
+        _send_to_slack(message, channel, 'Phabricator Fox', ':fox:')
+    elif not _is_repeat(message, channel):
+        _fox_digest.add(channel, message)
+
+
+def _extra_channels(repo_callsign, author):
+    """Return the channels besides #1s-and-0s-commits that care about a diff
+    against the given repo by the given author."""
+    routing = _routing.get()
+    extra_channels = set()
+    for channel in routing.callsign_channels.get(repo_callsign, []):
+        extra_channels.add(channel)
+
+    for channel in routing.user_channels.get(author, []):
+        extra_channels.add(channel)
+    return extra_channels
 
 
 def _build_slack_message(phid_info, transaction_type, author_phid):
@@ -192,6 +587,9 @@ def _build_slack_message(phid_info, transaction_type, author_phid):
     return message
 
 
+@deadline.timed('author')
+@parallel.hedged('user.search')
+@tracing.traced('conduit.user.search')
 def _get_author_username(author_phid):
     phab = _get_phabricator()
     constraints = {"phids": [author_phid]}
@@ -200,12 +598,177 @@ def _get_author_username(author_phid):
         return resp['data'][0]['fields']['username']
 
 
+def _iter_phabricator_users():
+    """Yield every (non-bot) Phabricator user, as returned by user.search."""
+    after = None
+    while True:
+        kwargs = {'constraints': {'isBot': False}, 'limit': 100}
+        if after:
+            kwargs['after'] = after
+        # A new client each page, so each gets what's left of the budget.
+        phab = _get_phabricator()
+        resp = phab.phid.user.search(**kwargs).response
+        for user in resp['data']:
+            yield user
+        after = (resp.get('cursor') or {}).get('after')
+        if not after:
+            return
+
+
+def _iter_slack_users():
+    """Yield every Slack user, as returned by users.list."""
+    cursor = None
+    while True:
+        params = {'limit': 200}
+        if cursor:
+            params['cursor'] = cursor
+        resp = _slack_session.get('https://slack.com/api/users.list',
+                                  params=params,
+                                  headers=_slack_headers(),
+                                  timeout=deadline.current().timeout()).json()
+        if not resp.get('ok'):
+            raise RuntimeError(
+                "Slack users.list failed: %s" % resp.get('error'))
+        for member in resp['members']:
+            yield member
+        cursor = resp.get('response_metadata', {}).get('next_cursor')
+        if not cursor:
+            return
+
+
+# If loading the user index fails (say our Slack token is missing a scope),
+# how long to wait before a request tries again.  Until then, we fall back
+# to asking Phabricator about each author; warmup and cron try regardless.
+_USER_INDEX_RETRY_INTERVAL = datetime.timedelta(minutes=10)
+
+# When a request may next try to load the user index, if it's not loaded.
+_user_index_retry_at = 0
+
+
+def _refresh_user_index():
+    user_index.replace(list(_iter_phabricator_users()),
+                       list(_iter_slack_users()))
+
+
+def _load_user_index_if_due():
+    """Load the user index if it's never loaded and we haven't just failed
+    to."""
+    global _user_index_retry_at
+    if user_index.loaded() or time.time() < _user_index_retry_at:
+        return
+    # Set this first, so other requests don't all try at once.
+    _user_index_retry_at = (
+        time.time() + _USER_INDEX_RETRY_INTERVAL.total_seconds())
+    try:
+        _refresh_user_index()
+    except Exception:
+        logging.exception("Unable to load the user index; not trying again "
+                          "for %s" % _USER_INDEX_RETRY_INTERVAL)
+
+
+def _author_from_phid(author_phid):
+    """Return (username, Slack markup to mention them) for a user's PHID.
+
+    This is normally answered from user_index; we only fall back to asking
+    Phabricator if the user is newer than the index.
+    """
+    _load_user_index_if_due()
+
+    user = user_index.by_phid(author_phid)
+    if user is None:
+        if not deadline.current().can_afford(
+                _OPTIONAL_CALL_BUDGET.total_seconds()):
+            logging.warning("Not enough time to look up %s" % author_phid)
+            return None, author_phid
+        try:
+            username = _get_author_username(author_phid)
+        except deadline.BudgetExhausted as e:
+            logging.warning("Not looking up %s: %s" % (author_phid, e))
+            return None, author_phid
+        return username, username
+    return user.username, user_index.mention(user.username)
+
+
+@deadline.timed('phid-query')
+@parallel.hedged('phid.query')
+@tracing.traced('conduit.phid.query')
 def _phid_query_from_phid(phid):
-    phab = _get_phabricator()
+    # Without this there's nothing to post, so it's critical.
+    phab = _get_phabricator(critical=True)
     return phab.phid.phid.query(phids=[phid]).response
 
 
-class PhabricatorFox(webapp2.RequestHandler):
+def _object_info_from_phid(phid):
+    """Return (phid info, repo callsign) for a diff, or (None, None).
+
+    The callsign lookup needs the diff ID from the phid info, so these two
+    have to happen one after the other.
+    """
+    return _step_result(_object_info_steps(phid))
+
+
+def _object_info_steps(phid):
+    """Step generator for _object_info_from_phid."""
+    phid_query = yield _StepCall('phid-query', phid)
+    # Since we're only passing in 1 phid, there should only be
+    # one (key, value) pair returned. We are only interested
+    # in the value.
+    if not phid_query:
+        yield None, None
+        return
+    phid_info = phid_query.values()[0]
+    # If phid_info['name'] returns D123, 123 is the diff ID, so we
+    # remove the first character
+    repo_callsign = yield _StepCall(
+        'diff-callsign', int(phid_info['name'].lstrip('D')))
+    yield phid_info, repo_callsign
+
+
+def warmup():
+    """Do everything a new instance would otherwise do on its first request.
+
+    This loads timezone data, opens our Slack connection, makes sure
+    Phabricator is reachable, and loads our routing and the user map.  Returns
+    a dict from step name to the seconds it took.
+    """
+    steps = [
+        ('timezone', pager_parrot.load_timezone),
+        ('slack-connection', lambda: _slack_session.post(
+            'https://slack.com/api/auth.test', headers=_slack_headers(),
+            timeout=deadline.current().timeout())),
+        ('phabricator-connection',
+         lambda: _get_phabricator().phid.conduit.ping()),
+        ('routing', lambda: (_routing.get(), pager_parrot.routing())),
+        ('user-index',
+         lambda: user_index.loaded() or _refresh_user_index()),
+    ]
+    with deadline.installed(deadline.Deadline()) as d:
+        for name, step in steps:
+            with d.stage(name):
+                try:
+                    step()
+                except Exception:
+                    # A failed step just means the first real request will
+                    # have to do it instead.
+                    logging.exception("Warmup step %s failed" % name)
+    d.report()
+    return d.stage_times
+
+
+class _BudgetedHandler(webapp2.RequestHandler):
+    """A handler that runs under a per-request deadline.started() budget."""
+    def dispatch(self):
+        with deadline.started(_REQUEST_BUDGET.total_seconds(),
+                              _CRITICAL_RESERVE.total_seconds()), \
+                tracing.trace(self.request.path):
+            if profiler.wanted(self.request.headers,
+                               getattr(secrets, 'profile_secret', None)):
+                with profiler.sampling():
+                    return super(_BudgetedHandler, self).dispatch()
+            return super(_BudgetedHandler, self).dispatch()
+
+
+class PhabricatorFox(_BudgetedHandler):
     """Handler that is run when `new-phabricator-feed` is triggered.
 
     Following the deprecation of the feed.http-hooks, this handler
@@ -214,7 +777,8 @@ class PhabricatorFox(webapp2.RequestHandler):
     """
     def post(self):
         logging.info("Processing %s" % self.request.body)
-        request_body = json.loads(self.request.body)
+        with deadline.current().stage('parse'), tracing.span('parse'):
+            request_body = json.loads(self.request.body)
         phid = request_body['object']['phid']
         if not request_body['transactions']:
             # For closing a diff, the transaction list is empty,
@@ -225,60 +789,48 @@ class PhabricatorFox(webapp2.RequestHandler):
         phid_map = {
             'phids': [t['phid'] for t in request_body['transactions']]
         }
-        resp = _transaction_search_from_phids(phid, phid_map)
+        try:
+            resp = _transaction_search_from_phids(phid, phid_map)
+        except deadline.BudgetExhausted as e:
+            # We can't do anything without the transactions; let Phabricator
+            # retry later.
+            logging.warning("Not fetching transactions on %s: %s" % (phid, e))
+            self.response.set_status(503)
+            return
         if not resp:
             logging.info("No response found for phid: %s" % (phid))
             self.response.set_status(404)
             return
-        data = resp['data']
-        for transaction in data:
-            trans_type = transaction.get('type')
-            if trans_type not in ['create', 'abandon']:
-                logging.info(
-                    "Transaction %s not a match. Skipping!" % trans_type)
-                continue
-            author_phid = transaction['authorPHID']
+        # We only look up the object once we see a transaction we care about,
+        # but then we do so at the same time as looking up the author.
+        object_info = None
+        for transaction in _iter_transactions(
+                phid, phid_map, resp, ACTIONS_MAP):
+            trans_type = transaction['type']
             logging.info("Transaction type: %s" % (trans_type))
-            phid_query = _phid_query_from_phid(phid)
-            # Since we're only passing in 1 phid, there should only be
-            # one (key, value) pair returned. We are only interested
-            # in the value.
-            if not phid_query:
+            if object_info is None:
+                object_info = parallel.start(_object_info_from_phid, phid)
+            author_info = parallel.start(
+                _author_from_phid, transaction['authorPHID'])
+
+            phid_info, repo_callsign = object_info.result()
+            author, author_mention = author_info.result()
+            if not phid_info:
                 logging.info("No info found for %s" % (phid))
                 continue
-            phid_info = phid_query.values()[0]
-            author = _get_author_username(author_phid)
-            message = _build_slack_message(phid_info, trans_type, author)
-            # If phid_info['name'] returns D123, 123 is the repository
-            # PHID, so we remove the first character
-            repo_phid = _repository_phid_from_diff_id(
-                int(phid_info['name'].lstrip('D')))
-            repo_callsign = None
-            if repo_phid:
-                repo_callsign = _callsign_from_repository_phid(repo_phid)
-                if not repo_callsign:
-                    logging.info(
-                        "Unable to get repo callsign for %s" % repo_phid)
-
-            _send_to_slack(
-                message, '#1s-and-0s-commits', 'Phabricator Fox', ':fox:')
-
-            extra_channels = set()
-            for channel in CALLSIGN_CHANNEL_MAP.get(repo_callsign, []):
-                extra_channels.add(channel)
-
-            for channel in USER_CHANNEL_MAP.get(author, []):
-                extra_channels.add(channel)
-
-            for channel in extra_channels:
-                _send_to_slack(message, channel, 'Phabricator Fox', ':fox:')
+            message = _build_slack_message(
+                phid_info, trans_type, author_mention)
+
+            _send_fox_message(message, '#1s-and-0s-commits')
+            for channel in _extra_channels(repo_callsign, author):
+                _send_fox_message(message, channel)
 
         self.response.headers['Content-Type'] = 'text/plain'
         self.response.write('OK')
 
 
 # Add me to feed.http-hooks in Phabricator config
-class PhabFox(webapp2.RequestHandler):
+class PhabFox(_BudgetedHandler):
     """Handler that sends PhabFox alerts for reviews being requested.
 
     With the transition to the new Phabricator feed system, the
@@ -302,31 +854,14 @@ class PhabFox(webapp2.RequestHandler):
                 message = u':phabricator: <%s|%s>: %s (%s by %s)' % (
                     url, match.group('code'),
                     match.group('description'),
-                    match.group('action'), author)
+                    match.group('action'), user_index.mention(author))
 
-                repo_phid = _repository_phid_from_diff_id(
+                repo_callsign = _callsign_from_diff_id(
                     int(match.group('code')[1:]))
-                repo_callsign = None
-                if repo_phid:
-                    repo_callsign = _callsign_from_repository_phid(repo_phid)
-                    if not repo_callsign:
-                        logging.info(
-                                "Unable to determine repo callsign for %s" %
-                                repo_phid)
-
-                _send_to_slack(
-                    message, '#1s-and-0s-commits', 'Phabricator Fox', ':fox:')
-
-                extra_channels = set()
-                for channel in CALLSIGN_CHANNEL_MAP.get(repo_callsign, []):
-                    extra_channels.add(channel)
-
-                for channel in USER_CHANNEL_MAP.get(author, []):
-                    extra_channels.add(channel)
-
-                for channel in extra_channels:
-                    _send_to_slack(
-                            message, channel, 'Phabricator Fox', ':fox:')
+
+                _send_fox_message(message, '#1s-and-0s-commits')
+                for channel in _extra_channels(repo_callsign, author):
+                    _send_fox_message(message, channel)
             else:
                 logging.info("Story text didn't match regexp. Text was: %s" %
                         self.request.get('storyText'))
@@ -340,40 +875,197 @@ class PhabFox(webapp2.RequestHandler):
 
 # Add me as an outgoing webhook for a service in PagerDuty.
 # See https://khanacademy.org/r/911 for details.
-class PagerParrot(webapp2.RequestHandler):
+class PagerParrot(_BudgetedHandler):
     # TODO(benkraft): this has no auth whatsoever.  I'm not too worried about
     # it, but we might want to do some sort of checking (e.g. via hitting the
     # PagerDuty API) or use an obscure URL.
     def post(self):
         logging.info("Processing %s" % self.request.body)
-        payload = json.loads(self.request.body)
+        with deadline.current().stage('parse'), tracing.span('parse'):
+            payload = json.loads(self.request.body)
 
         global pagerduty_ids_seen
         for message in payload['messages']:
-            if (message['id'] not in pagerduty_ids_seen and
-                    message['type'] == 'incident.trigger'
-                    ):
-                should_ping = pager_parrot.consider_ping()
-                # Only trigger if we haven't seen the message, and if it's a
-                # trigger, rather than an acknowledgement or resolve.
-                for channel in pager_parrot.CHANNELS:
-                    resp = _send_to_slack(
-                        pager_parrot.format_message(
-                            message['data']['incident'], channel,
-                            should_ping=should_ping),
-                        channel, 'Pager Parrot', ':parrot:',
-                        thread=pager_parrot.get_channel_thread(channel))
-
-                    # We should stash any thread info for future use
-                    msg = resp.json()
-                    if 'ts' in msg:
-                        pager_parrot.set_channel_thread(channel, msg['ts'])
-
-                pagerduty_ids_seen.add(message['id'])
+            if message['id'] in pagerduty_ids_seen:
+                continue
+            incident = message['data']['incident']
+            if message['type'] == 'incident.trigger':
+                self._post_incident(incident)
+            elif message['type'] in pager_parrot.LIFECYCLE_STATUSES:
+                # Rather than posting again, we update what we posted for
+                # the trigger, so channels can see what's still open.
+                self._update_incident(incident, message['type'])
+            pagerduty_ids_seen.add(message['id'])
+
+    def _post_incident(self, incident):
+        should_ping = pager_parrot.consider_ping(
+            incident.get('service', {}).get('id'))
+        routing = pager_parrot.routing()
+        for channel in pager_parrot.channels_for_incident(incident, routing):
+            text = pager_parrot.format_message(
+                incident, channel, should_ping=should_ping, routing=routing)
+            resp = _send_to_slack(
+                text, channel, 'Pager Parrot', ':parrot:',
+                thread=pager_parrot.get_channel_thread(channel, routing))
+            if resp is None:
+                continue
+
+            # We should stash any thread info for future use
+            msg = resp.json()
+            if 'ts' in msg:
+                pager_parrot.set_channel_thread(channel, msg['ts'], routing)
+                pager_parrot.record_incident_message(
+                    incident['id'], msg['channel'], msg['ts'], text)
+
+    def _update_incident(self, incident, message_type):
+        posts = pager_parrot.incident_messages(incident['id'])
+        if not posts:
+            logging.info("No messages to update for incident %s"
+                         % incident['id'])
+        # We update every channel even if one fails, and raise afterwards so
+        # PagerDuty retries; updating a message twice is harmless.
+        failures = []
+        for channel_id, ts, text in posts:
+            try:
+                resp = _update_slack_message(
+                    pager_parrot.format_status_update(
+                        text, message_type, incident),
+                    channel_id, ts)
+            except Exception as e:
+                logging.exception("Couldn't update %s in %s"
+                                  % (ts, channel_id))
+                failures.append('%s (%s)' % (channel_id, e))
+                continue
+            if not _slack_accepted(resp):
+                failures.append('%s (%s)' % (channel_id, resp.text))
+        if failures:
+            raise RuntimeError("chat.update failed for %s"
+                               % ', '.join(failures))
+        # Once it's resolved, we won't need to update it again.
+        if message_type == 'incident.resolve':
+            pager_parrot.forget_incident_messages(incident['id'])
+
+
+class BackfillDiffIndex(webapp2.RequestHandler):
+    """Admin-only handler to fill in diff_index from Phabricator.
+
+    Takes optional `offset` and `max_pages` query parameters, and responds
+    with the offset to pass next time, or "done".
+    """
+    def get(self):
+        offset = int(self.request.get('offset', 0))
+        max_pages = int(self.request.get('max_pages', 20))
+        next_offset = _backfill_diff_index(offset, max_pages)
+        logging.info("Diff index has %s entries in memory" % diff_index.size())
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write(
+            'done' if next_offset is None else str(next_offset))
+
+
+class RefreshUserIndex(webapp2.RequestHandler):
+    """Admin-only handler to reload user_index; run from cron.yaml."""
+    def get(self):
+        _refresh_user_index()
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write('OK')
+
+
+class Profile(webapp2.RequestHandler):
+    """Admin-only handler for the sampling profiler in profiler.py.
+
+    GET returns the samples so far (pass `top` to see more or fewer hot
+    functions).  POST with `seconds` profiles every request for that long,
+    and POST with `reset` throws away the samples so far.
+    """
+    def get(self):
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write(profiler.report(int(self.request.get('top', 20))))
+
+    def post(self):
+        if self.request.get('reset'):
+            profiler.reset()
+        if self.request.get('seconds'):
+            profiler.profile_all_for(float(self.request.get('seconds')))
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write('OK')
+
+
+class RoutingConfig(webapp2.RequestHandler):
+    """Admin-only handler to see or change our routing config.
+
+    GET returns the routing.json we're using.  PUT a new one as the body to
+    replace it; every instance picks it up within a few seconds.  See
+    config_file.py.
+    """
+    def get(self):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(config_file.current_text(config_file.PATH))
+
+    def put(self):
+        self.response.headers['Content-Type'] = 'text/plain'
+        # Make sure it builds before anyone else tries to use it.
+        try:
+            config = json.loads(self.request.body)
+            _build_routing(config, _routing.get())
+            pager_parrot.build_routing(config, pager_parrot.routing())
+        except Exception as e:
+            logging.exception("Not saving the new routing config")
+            self.response.set_status(400)
+            self.response.write('Bad routing config: %r\n' % e)
+            return
+        version = config_file.save(config_file.PATH, self.request.body)
+        _routing.reload()
+        pager_parrot._routing.reload()
+        self.response.write('Saved version %s\n' % version)
+
+
+class Memory(webapp2.RequestHandler):
+    """Admin-only handler for the memory accounting in memory.py.
+
+    GET returns the size of each registered structure, and the types that
+    have grown most since the baseline (pass `top` to see more or fewer).
+    POST with `baseline` takes a new baseline.
+    """
+    def get(self):
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write(memory.report(int(self.request.get('top', 20))))
+
+    def post(self):
+        if self.request.get('baseline'):
+            memory.set_baseline()
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write('OK')
+
+
+class Warmup(webapp2.RequestHandler):
+    """App Engine sends this to a new instance before giving it traffic."""
+    def get(self):
+        stage_times = warmup()
+        self.response.headers['Content-Type'] = 'text/plain'
+        for name, seconds in sorted(stage_times.items()):
+            self.response.write('%s: %.3fs\n' % (name, seconds))
+
+
+class Stop(webapp2.RequestHandler):
+    """App Engine sends this to a manually-scaled instance before it stops."""
+    def get(self):
+        _flush_fox_digest()
+        tracing.export()
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write('OK')
 
 
 app = webapp2.WSGIApplication([
     ('/new-phabricator-feed', PhabricatorFox),
     ('/phabricator-feed', PhabFox),
     ('/pagerduty-feed', PagerParrot),
+    # Imported lazily, since bulk_feed imports us.
+    ('/admin/bulk-feed', 'bulk_feed.BulkFeed'),
+    ('/admin/backfill-diff-index', BackfillDiffIndex),
+    ('/admin/refresh-user-index', RefreshUserIndex),
+    ('/admin/profile', Profile),
+    ('/admin/memory', Memory),
+    ('/admin/routing', RoutingConfig),
+    ('/_ah/warmup', Warmup),
+    ('/_ah/stop', Stop),
 ])
@@ -0,0 +1,157 @@
+"""Memory accounting for long-lived instances.
+
+We run on a single manual-scaling instance that may live for weeks, and a
+lot of our state lives in instance memory.  Each module registers the
+structures that might grow with `register()`, and `report()` lists how many
+entries each has and roughly how many bytes it takes up.
+
+To find growth in things nobody registered, `set_baseline()` counts the
+live objects of each type, and `report()` then lists the types that have
+grown the most since.  (Python 2 has no tracemalloc, so we can't say where
+objects were allocated, only what type they are; and gc only sees container
+objects, so strings and numbers show up only through what holds them.)
+This walks the whole heap, so it's for admins to run by hand.
+"""
+import collections
+import gc
+import logging
+import sys
+import threading
+import time
+import types
+
+
+# Objects we don't count towards a structure's size when we find them inside
+# it: they're shared with the rest of the program, not owned by it.
+_SHARED_TYPES = (types.ModuleType, type, types.ClassType,
+                 types.FunctionType, types.MethodType,
+                 types.BuiltinFunctionType)
+
+# Map from name to (function returning the structure, function returning
+# its number of entries, or None).
+_registry = {}
+_registry_lock = threading.Lock()
+
+# (time taken, Counter from type name to count, Counter from type name to
+# bytes), or None if no baseline's been taken.
+_baseline = None
+
+
+def register(name, get, count=None):
+    """Report on the structure returned by `get()` as `name`.
+
+    Its number of entries comes from `count()` if given, or else from its
+    len() or size() if it has one.
+    """
+    with _registry_lock:
+        _registry[name] = (get, count)
+
+
+def _entries(obj, count):
+    if count is not None:
+        return count()
+    if hasattr(obj, '__len__'):
+        return len(obj)
+    if hasattr(obj, 'size'):
+        return obj.size()
+    return None
+
+
+def _deep_size(obj):
+    """Return roughly how many bytes `obj` and everything it holds take."""
+    seen = set()
+    pending = [obj]
+    total = 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, _SHARED_TYPES):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj, 0)
+        if isinstance(obj, dict):
+            pending.extend(obj.keys())
+            pending.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+            pending.extend(obj)
+        if hasattr(obj, '__dict__'):
+            pending.append(obj.__dict__)
+        for slot in getattr(type(obj), '__slots__', ()):
+            if hasattr(obj, slot):
+                pending.append(getattr(obj, slot))
+    return total
+
+
+def sizes():
+    """Return a list of (name, entries, bytes) for each registered structure.
+
+    Entries is None if the structure doesn't have a count.
+    """
+    with _registry_lock:
+        registry = sorted(_registry.items())
+    result = []
+    for name, (get, count) in registry:
+        try:
+            obj = get()
+            result.append((name, _entries(obj, count), _deep_size(obj)))
+        except Exception:
+            # Most likely another thread changed it while we looked.
+            logging.exception("Unable to measure %s" % name)
+    return result
+
+
+def _type_name(obj):
+    cls = getattr(obj, '__class__', type(obj))
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+
+def _count_objects():
+    counts = collections.Counter()
+    byte_counts = collections.Counter()
+    for obj in gc.get_objects():
+        name = _type_name(obj)
+        counts[name] += 1
+        byte_counts[name] += sys.getsizeof(obj, 0)
+    return counts, byte_counts
+
+
+def set_baseline():
+    """Count the live objects of each type, to compare against later."""
+    global _baseline
+    gc.collect()
+    counts, byte_counts = _count_objects()
+    _baseline = (time.time(), counts, byte_counts)
+
+
+def growth(top_n):
+    """Return the top_n types that have grown the most since the baseline,
+    as a list of (type name, added objects, added bytes), or None if there's
+    no baseline."""
+    if _baseline is None:
+        return None
+    _, old_counts, old_byte_counts = _baseline
+    gc.collect()
+    counts, byte_counts = _count_objects()
+    added = collections.Counter(byte_counts)
+    added.subtract(old_byte_counts)
+    return [(name, counts[name] - old_counts[name], size)
+            for name, size in added.most_common(top_n) if size > 0]
+
+
+def report(top_n=20):
+    """Return a plain-text report: registered structures, then growth."""
+    lines = ['# %-40s %10s %12s' % ('structure', 'entries', 'bytes')]
+    for name, entries, size in sizes():
+        lines.append('%-42s %10s %12s' % (
+            name, '-' if entries is None else entries, size))
+
+    lines.append('')
+    changes = growth(top_n)
+    if changes is None:
+        lines.append('# No baseline; POST baseline=1 to take one.')
+    else:
+        lines.append('# Top %s types by growth in the %ds since the baseline:'
+                     % (top_n, time.time() - _baseline[0]))
+        lines.append('# %-40s %10s %12s' % ('type', 'objects', 'bytes'))
+        for name, objects, size in changes:
+            lines.append('%-42s %+10d %+12d' % (name, objects, size))
+    return '\n'.join(lines) + '\n'
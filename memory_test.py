@@ -0,0 +1,61 @@
+import unittest
+
+import mock
+
+import memory
+
+
+class MemoryTest(unittest.TestCase):
+    def setUp(self):
+        for patcher in [mock.patch.dict(memory._registry, clear=True),
+                        mock.patch('memory._baseline', None)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_sizes(self):
+        class Cache(object):
+            def __init__(self):
+                self._entries = {'a': 'x' * 1000}
+
+            def size(self):
+                return len(self._entries)
+
+        items = set(['one', 'two'])
+        memory.register('items', lambda: items)
+        memory.register('cache', Cache)
+        memory.register('counted', lambda: object(), count=lambda: 7)
+        sizes = dict((name, (entries, size))
+                     for name, entries, size in memory.sizes())
+        self.assertEqual(sizes['items'][0], 2)
+        self.assertEqual(sizes['cache'][0], 1)
+        self.assertGreater(sizes['cache'][1], 1000)
+        self.assertEqual(sizes['counted'][0], 7)
+
+    def test_unmeasurable_structure_skipped(self):
+        memory.register('broken', lambda: 1 / 0)
+        memory.register('fine', lambda: [])
+        self.assertEqual([name for name, _, _ in memory.sizes()], ['fine'])
+
+    def test_growth(self):
+        class Leaky(object):
+            pass
+
+        self.assertIsNone(memory.growth(5))
+        memory.set_baseline()
+        leaked = [Leaky() for _ in xrange(1000)]
+        growth = dict((name, objects)
+                      for name, objects, _ in memory.growth(100))
+        self.assertEqual(growth['memory_test.Leaky'], 1000)
+        self.assertEqual(len(leaked), 1000)
+
+    def test_report(self):
+        memory.register('items', lambda: [1, 2, 3])
+        report = memory.report()
+        self.assertIn('items', report)
+        self.assertIn('No baseline', report)
+        memory.set_baseline()
+        self.assertIn('since the baseline', memory.report())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,17 +1,19 @@
 """Pure utilities and configuration settings for Pager Parrot."""
+import collections
 import datetime
 import textwrap
 import threading
 
+import config_file
+import memory
+
 # Values for channel_type.
 # Different types of channels: what kind of message do we deliver?
 _FIRST_PARTY = 'ChannelType[_FIRST_PARTY]'
 _THIRD_PARTY = 'ChannelType[_THIRD_PARTY]'
 
 
-# Globals and constants for consider_ping
-_last_ping = datetime.datetime.min
-_last_message = datetime.datetime.min
+# Constants for consider_ping
 _PING_AFTER_MESSAGE_TIMEOUT = datetime.timedelta(minutes=30)
 _PING_AFTER_PING_TIMEOUT = datetime.timedelta(hours=3)
 _CREATE_NEW_THREAD_TIMEOUT = datetime.timedelta(minutes=15)
@@ -33,6 +35,10 @@ class Configuration(object):
         self.last_thread_started = datetime.datetime.min
         self._lock = threading.Lock()
 
+    def settings(self):
+        return (self.channel_type, self.high_priority_action,
+                self.medium_priority_action, self.low_priority_action)
+
     def get_thread(self):
         with self._lock:
             prev_thread = self.previous_thread_id
@@ -57,7 +63,49 @@ class Configuration(object):
             self.previous_thread_id = thread_id
 
 
-def consider_ping():
+class _PingThrottle(object):
+    """The state behind consider_ping: when we last messaged and pinged about
+    each PagerDuty service."""
+    def __init__(self):
+        # Map from service ID to (time of last message, time of last ping).
+        self._state = {}
+        self._last_eviction = datetime.datetime.min
+        self._lock = threading.Lock()
+
+    def consider(self, service, now):
+        with self._lock:
+            last_message, last_ping = self._state.get(
+                service, (datetime.datetime.min, datetime.datetime.min))
+
+            will_ping = not (
+                # Skip a ping if our last message *and* last ping were recent.
+                now - last_message < _PING_AFTER_MESSAGE_TIMEOUT and
+                now - last_ping < _PING_AFTER_PING_TIMEOUT)
+
+            self._state[service] = (now, now if will_ping else last_ping)
+
+            if now - self._last_eviction >= _PING_AFTER_MESSAGE_TIMEOUT:
+                self._evict_idle(now)
+
+        return will_ping
+
+    def _evict_idle(self, now):
+        # A service we haven't messaged about recently will get a ping next
+        # time whatever its last ping was, so we can just forget it.
+        self._last_eviction = now
+        for service, (last_message, _) in self._state.items():
+            if now - last_message >= _PING_AFTER_MESSAGE_TIMEOUT:
+                del self._state[service]
+
+    def size(self):
+        return len(self._state)
+
+
+_ping_throttle = _PingThrottle()
+memory.register('pager_parrot.ping_throttle', lambda: _ping_throttle)
+
+
+def consider_ping(service=None):
     """Consider whether to @channel for a Pager Parrot message now.
 
     If there are a bunch of distinct alerts in a short period of time,
@@ -73,24 +121,14 @@ def consider_ping():
     bunch of @channels, but an incident that is resolved, and then recurs a few
     hours later, will.
 
+    We keep track of this separately for each PagerDuty service ID, so that a
+    noisy service can't keep us from pinging about another one.
+
     Like main.pagerduty_ids_seen, we just keep this in instance memory, because
     a false positive occasionally is way better than Pager Parrot crashing
     because it can't talk to the datastore.
     """
-    global _last_ping
-    global _last_message
-    now = datetime.datetime.now()
-
-    will_ping = not (
-        # Skip a ping if our last message *and* last ping were recent.
-        now - _last_message < _PING_AFTER_MESSAGE_TIMEOUT and
-        now - _last_ping < _PING_AFTER_PING_TIMEOUT)
-
-    _last_message = now
-    if will_ping:
-        _last_ping = now
-
-    return will_ping
+    return _ping_throttle.consider(service, datetime.datetime.now())
 
 
 def _preprocess_base_message(msg):
@@ -136,32 +174,194 @@ _ACTIONS = {
 }
 
 
-# See 'Configuration' docstring for what these do.
-CHANNELS = {
-    '#1s-and-0s':
-        Configuration(channel_type=_FIRST_PARTY,
-                      high_priority_action=_PING_WITH_AT_CHANNEL,
-                      medium_priority_action=_PING_WITH_AT_CHANNEL,
-                      low_priority_action=_SUPPRESS_PING),
-    '#user-issues':
-        Configuration(channel_type=_THIRD_PARTY,
-                      high_priority_action=_PING_WITH_AT_HERE,
-                      medium_priority_action=_PING_WITH_AT_HERE,
-                      low_priority_action=_PING_WITH_AT_HERE),
+# How channel types and actions are named in routing.json.
+_CHANNEL_TYPE_NAMES = {
+    'first_party': _FIRST_PARTY,
+    'third_party': _THIRD_PARTY,
+}
+_ACTION_NAMES = {
+    'at_channel': _PING_WITH_AT_CHANNEL,
+    'at_here': _PING_WITH_AT_HERE,
+    'suppress': _SUPPRESS_PING,
 }
 
 
-def get_channel_thread(for_channel):
-    channel = CHANNELS[for_channel]
+# A rule for which channels hear about which incidents.  An incident goes to
+# `channels` if it comes from one of the PagerDuty service IDs in `services`,
+# has one of the `urgencies` ('high' or 'low'), and starts during one of the
+# `hours` (0-23, US/Pacific) on a weekday or weekend as given by `weekdays`.
+# Leave any of those as None to match everything.  An incident goes to every
+# channel from every route it matches.  These come from the "routes" in the
+# "pager_parrot" section of routing.json.
+class Route(object):
+    def __init__(self, channels, services=None, urgencies=None,
+                 weekdays=None, hours=None):
+        self.channels = frozenset(channels)
+        self.services = services
+        self.urgencies = urgencies
+        self.weekdays = weekdays
+        self.hours = hours
+
+    def matches(self, service, urgency, is_weekday, hour):
+        return ((self.services is None or service in self.services) and
+                (self.urgencies is None or urgency in self.urgencies) and
+                (self.weekdays is None or self.weekdays == is_weekday) and
+                (self.hours is None or hour in self.hours))
+
+
+_URGENCIES = ('high', 'low')
+
+
+def compile_routes(routes, channels):
+    """Turn a list of Routes into a table for channels_for_incident().
+
+    Returns a pair: the set of service IDs some route names, and a dict from
+    (service ID, urgency, is_weekday, hour) to the frozenset of channels,
+    where the service ID is None for every other service.  All channels must
+    be in `channels`, so we know how to format the message.
+    """
+    for route in routes:
+        unknown = route.channels - set(channels)
+        if unknown:
+            raise ValueError("No Configuration for channels %s"
+                             % ', '.join(sorted(unknown)))
+
+    services = frozenset(service for route in routes
+                         for service in route.services or ())
+    table = {}
+    for service in list(services) + [None]:
+        for urgency in _URGENCIES:
+            for is_weekday in (True, False):
+                for hour in xrange(24):
+                    table[(service, urgency, is_weekday, hour)] = frozenset(
+                        channel for route in routes
+                        if route.matches(service, urgency, is_weekday, hour)
+                        for channel in route.channels)
+    return services, table
+
+
+# Our routing configuration: a map from channel name to Configuration, and
+# the compiled routes.
+Routing = collections.namedtuple('Routing', ['channels', 'services', 'table'])
+
+
+def build_routing(config, previous=None):
+    """Build our Routing from the parsed routing.json.
+
+    Channels whose settings haven't changed keep their Configuration from
+    `previous`, so that we keep posting in the same Slack thread.
+    """
+    config = config['pager_parrot']
+    channels = {}
+    for name, settings in config['channels'].iteritems():
+        channel = Configuration(
+            channel_type=_CHANNEL_TYPE_NAMES[settings['channel_type']],
+            high_priority_action=_ACTION_NAMES[
+                settings['high_priority_action']],
+            medium_priority_action=_ACTION_NAMES[
+                settings['medium_priority_action']],
+            low_priority_action=_ACTION_NAMES[
+                settings['low_priority_action']])
+        old_channel = previous and previous.channels.get(name)
+        if old_channel and old_channel.settings() == channel.settings():
+            channel = old_channel
+        channels[name] = channel
+
+    routes = [Route(**route) for route in config['routes']]
+    services, table = compile_routes(routes, channels)
+    return Routing(channels, services, table)
+
+
+_routing = config_file.Watched(config_file.PATH, build_routing)
+memory.register('pager_parrot.routing', lambda: _routing)
+
+
+def routing():
+    """Return the current Routing.
+
+    Fetch this once per incident and pass it to the functions below, so that
+    a reload part-way through can't leave us posting to a channel the new
+    routing doesn't know.
+    """
+    return _routing.get()
+
+
+def channels_for_incident(incident, routing=None):
+    """Return the set of channels that should hear about an incident."""
+    routing = routing or _routing.get()
+    service = incident.get('service', {}).get('id')
+    if service not in routing.services:
+        service = None
+    now = _now_us_pacific()
+    return routing.table.get(
+        (service, incident['urgency'], now.weekday() < 5, now.hour),
+        frozenset())
+
+
+def get_channel_thread(for_channel, routing=None):
+    channel = (routing or _routing.get()).channels[for_channel]
     return channel.get_thread()
 
 
-def set_channel_thread(for_channel, thread_id):
-    channel = CHANNELS[for_channel]
+def set_channel_thread(for_channel, thread_id, routing=None):
+    channel = (routing or _routing.get()).channels[for_channel]
     channel.set_thread(thread_id)
 
 
-def format_message(incident, channel, should_ping=True):
+# How PagerDuty lifecycle message types are described when we update the
+# original post.
+LIFECYCLE_STATUSES = {
+    'incident.acknowledge': 'Acknowledged',
+    'incident.resolve': 'Resolved',
+}
+
+# We remember the Slack messages for this many open incidents, so that we can
+# update them when the incident is acknowledged or resolved.  Resolved
+# incidents are forgotten once updated; this bound is for ones that never are.
+_MAX_TRACKED_INCIDENTS = 500
+
+# Map from incident ID to a list of (channel ID, ts, text) for the messages
+# we posted about it, oldest incident first.
+_incident_messages = collections.OrderedDict()
+_incident_messages_lock = threading.Lock()
+memory.register('pager_parrot.incident_messages', lambda: _incident_messages)
+
+
+def record_incident_message(incident_id, channel_id, ts, text):
+    with _incident_messages_lock:
+        _incident_messages.setdefault(incident_id, []).append(
+            (channel_id, ts, text))
+        while len(_incident_messages) > _MAX_TRACKED_INCIDENTS:
+            _incident_messages.popitem(last=False)
+
+
+def incident_messages(incident_id):
+    """Return the (channel ID, ts, text) of the messages about an incident."""
+    with _incident_messages_lock:
+        return list(_incident_messages.get(incident_id, []))
+
+
+def forget_incident_messages(incident_id):
+    """Stop remembering the messages about an incident.
+
+    Only call this once they're all updated for good: if an update fails,
+    PagerDuty's retry will need to find them again.
+    """
+    with _incident_messages_lock:
+        _incident_messages.pop(incident_id, None)
+
+
+def format_status_update(original_text, message_type, incident):
+    """Return the text to replace an incident's message with, once it's been
+    acknowledged or resolved."""
+    status = LIFECYCLE_STATUSES[message_type]
+    changed_by = (incident.get('last_status_change_by') or {}).get('name')
+    if changed_by:
+        status = '%s by %s' % (status, changed_by)
+    return '%s\n*%s*' % (original_text, status)
+
+
+def format_message(incident, channel, should_ping=True, routing=None):
     trigger_summary_data = incident.get('trigger_summary_data', {})
 
     summary = '<no summary available>'
@@ -170,7 +370,7 @@ def format_message(incident, channel, should_ping=True):
     if 'description' in trigger_summary_data:
         summary = trigger_summary_data['description']
 
-    channel = CHANNELS[channel]
+    channel = (routing or _routing.get()).channels[channel]
 
     is_p911 = incident['urgency'] == 'high'
     is_weekday = _now_us_pacific().weekday() < 5
@@ -193,8 +393,23 @@ def format_message(incident, channel, should_ping=True):
         next_steps=next_steps)
 
 
+_us_pacific = None
+
+
+def load_timezone():
+    """Load the US/Pacific timezone, if we haven't already, and return it.
+
+    Loading pytz and its zone data is slow, so main.warmup() calls this
+    before the first incident comes in.
+    """
+    global _us_pacific
+    if _us_pacific is None:
+        # Late import so that we can avoid this in tests.
+        from third_party.pytz.gae import pytz
+        _us_pacific = pytz.timezone('US/Pacific')
+    return _us_pacific
+
+
 def _now_us_pacific():
     """Get the current date, in US/Pacific time."""
-    # Late import so that we can avoid this in tests.
-    from third_party.pytz.gae import pytz
-    return datetime.datetime.now(pytz.timezone('US/Pacific'))
+    return datetime.datetime.now(load_timezone())
@@ -1,7 +1,13 @@
 import datetime
+import json
 import mock
+import sys
+import threading
 import unittest
 
+import webapp2
+
+import main
 import pager_parrot
 
 
@@ -10,13 +16,23 @@ _CHANNEL_1P = "#nonexistent-test-channel-do-not-create"
 _CHANNEL_3P = "#nonexistent-test-channel-do-not-create-third-party"
 
 
+def _patch_routing(test, channels, routes=()):
+    """Use the given channels and Routes in place of routing.json."""
+    routing = pager_parrot.Routing(
+        channels, *pager_parrot.compile_routes(routes, channels))
+    patcher = mock.patch.object(pager_parrot._routing, 'get',
+                                return_value=routing)
+    patcher.start()
+    test.addCleanup(patcher.stop)
+
+
 class PagerParrotLogicTest(unittest.TestCase):
     """Test all configurations of the pager parrot behavior."""
 
     def setUp(self):
         super(PagerParrotLogicTest, self).setUp()
 
-        # Mock out the pager parrot's CHANNELS set for testing.
+        # Mock out the pager parrot's channels for testing.
         # Fortunately, we have as many actions as we have priority categories,
         # so we can test them all by creating a widespread configuration.
         config_1p = pager_parrot.Configuration(
@@ -29,16 +45,10 @@ class PagerParrotLogicTest(unittest.TestCase):
             high_priority_action=pager_parrot._PING_WITH_AT_CHANNEL,
             medium_priority_action=pager_parrot._PING_WITH_AT_HERE,
             low_priority_action=pager_parrot._SUPPRESS_PING)
-        patcher = mock.patch.dict(
-            pager_parrot.CHANNELS,
-            clear=True,
-            values={
-                _CHANNEL_1P: config_1p,
-                _CHANNEL_3P: config_3p,
-            }
-        )
-        patcher.start()
-        self.addCleanup(patcher.stop)
+        _patch_routing(self, {
+            _CHANNEL_1P: config_1p,
+            _CHANNEL_3P: config_3p,
+        })
 
     def test_high_priority_1p_weekday(self):
         incident = self._urgent_incident()
@@ -113,6 +123,64 @@ class PagerParrotLogicTest(unittest.TestCase):
         }
 
 
+class PagerParrotPingThrottleTest(unittest.TestCase):
+    def setUp(self):
+        self.throttle = pager_parrot._PingThrottle()
+        self.now = datetime.datetime(2018, 1, 1, 12, 0)
+
+    def test_pings_first_message_for_each_service(self):
+        self.assertTrue(self.throttle.consider('PSERVICE1', self.now))
+        self.assertFalse(self.throttle.consider('PSERVICE1', self.now))
+        self.assertTrue(self.throttle.consider('PSERVICE2', self.now))
+
+    def test_pings_again_after_quiet_period(self):
+        self.assertTrue(self.throttle.consider('PSERVICE1', self.now))
+        later = self.now + pager_parrot._PING_AFTER_MESSAGE_TIMEOUT
+        self.assertTrue(self.throttle.consider('PSERVICE1', later))
+
+    def test_pings_again_during_long_incident(self):
+        self.assertTrue(self.throttle.consider('PSERVICE1', self.now))
+        now = self.now
+        step = datetime.timedelta(minutes=10)
+        while now - self.now < pager_parrot._PING_AFTER_PING_TIMEOUT - step:
+            now += step
+            self.assertFalse(self.throttle.consider('PSERVICE1', now))
+        self.assertTrue(self.throttle.consider('PSERVICE1', now + step))
+
+    def test_evicts_idle_services(self):
+        for i in xrange(100):
+            self.throttle.consider('PSERVICE%s' % i, self.now)
+        later = self.now + pager_parrot._PING_AFTER_MESSAGE_TIMEOUT
+        self.throttle.consider('PSERVICE1', later)
+        self.assertEqual(self.throttle.size(), 1)
+
+    def test_concurrent_messages_ping_once_per_service(self):
+        services = ['PSERVICE%s' % i for i in xrange(5)]
+        pings = []
+        start = threading.Event()
+
+        def send(service):
+            start.wait()
+            for _ in xrange(20):
+                if self.throttle.consider(service, self.now):
+                    pings.append(service)
+
+        threads = [threading.Thread(target=send, args=(service,))
+                   for service in services for _ in xrange(10)]
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            for thread in threads:
+                thread.start()
+            start.set()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setcheckinterval(interval)
+
+        self.assertEqual(sorted(pings), services)
+
+
 class PagerParrotConfigurationTest(unittest.TestCase):
     """Test that the configuration is reasonable. These are not comprehensive.
 
@@ -120,7 +188,7 @@ class PagerParrotConfigurationTest(unittest.TestCase):
     """
 
     def test_1s0s_configured(self):
-        self.assertIn('#1s-and-0s', pager_parrot.CHANNELS)
+        self.assertIn('#1s-and-0s', pager_parrot._routing.get().channels)
 
     def test_p911_pings_channel_in_1s0s_on_weekday(self):
         incident = self._urgent_incident()
@@ -155,6 +223,215 @@ class PagerParrotConfigurationTest(unittest.TestCase):
         }
 
 
+class PagerParrotRoutingTest(unittest.TestCase):
+    def setUp(self):
+        super(PagerParrotRoutingTest, self).setUp()
+        self.channels = {'#infra': None, '#content': None, '#1s-and-0s': None}
+        _patch_routing(self, self.channels, [
+            pager_parrot.Route(channels={'#1s-and-0s'}, urgencies={'high'}),
+            pager_parrot.Route(channels={'#infra'}, services={'PINFRA'}),
+            pager_parrot.Route(channels={'#content'}, services={'PCONTENT'},
+                               weekdays=True, hours=range(9, 17)),
+        ])
+
+    def _channels(self, service, urgency):
+        return pager_parrot.channels_for_incident(
+            {'service': {'id': service}, 'urgency': urgency})
+
+    def test_by_service(self):
+        with _mocking_weekday():
+            self.assertEqual(self._channels('PINFRA', 'low'), {'#infra'})
+            self.assertEqual(self._channels('PINFRA', 'high'),
+                             {'#infra', '#1s-and-0s'})
+
+    def test_unknown_service(self):
+        with _mocking_weekday():
+            self.assertEqual(self._channels('PWHO', 'low'), set())
+            self.assertEqual(self._channels('PWHO', 'high'), {'#1s-and-0s'})
+
+    def test_by_time(self):
+        with _mocking_weekday():
+            self.assertEqual(self._channels('PCONTENT', 'low'), {'#content'})
+        with _mocking_weekend():
+            self.assertEqual(self._channels('PCONTENT', 'low'), set())
+
+    def test_unconfigured_channel(self):
+        self.assertRaises(ValueError, pager_parrot.compile_routes,
+                          [pager_parrot.Route(channels={'#nope'})],
+                          self.channels)
+
+
+class PagerParrotBuildRoutingTest(unittest.TestCase):
+    def _config(self, infra_action):
+        return {'pager_parrot': {
+            'channels': {
+                '#1s-and-0s': {
+                    'channel_type': 'first_party',
+                    'high_priority_action': 'at_channel',
+                    'medium_priority_action': 'at_channel',
+                    'low_priority_action': 'suppress',
+                },
+                '#infra': {
+                    'channel_type': 'first_party',
+                    'high_priority_action': infra_action,
+                    'medium_priority_action': 'at_here',
+                    'low_priority_action': 'suppress',
+                },
+            },
+            'routes': [
+                {'channels': ['#1s-and-0s']},
+                {'channels': ['#infra'], 'services': ['PINFRA']},
+            ],
+        }}
+
+    def test_build(self):
+        routing = pager_parrot.build_routing(self._config('at_channel'))
+        self.assertEqual(routing.services, {'PINFRA'})
+        self.assertEqual(
+            routing.channels['#infra'].high_priority_action,
+            pager_parrot._PING_WITH_AT_CHANNEL)
+
+    def test_unchanged_channels_kept(self):
+        old = pager_parrot.build_routing(self._config('at_channel'))
+        new = pager_parrot.build_routing(self._config('at_here'), old)
+        self.assertIs(new.channels['#1s-and-0s'], old.channels['#1s-and-0s'])
+        self.assertIsNot(new.channels['#infra'], old.channels['#infra'])
+        self.assertEqual(new.channels['#infra'].high_priority_action,
+                         pager_parrot._PING_WITH_AT_HERE)
+
+
+class PagerParrotRoutingConfigurationTest(unittest.TestCase):
+    def test_p911_goes_to_1s0s(self):
+        with _mocking_weekend():
+            self.assertIn('#1s-and-0s', pager_parrot.channels_for_incident(
+                {'service': {'id': 'PNOTREAL'}, 'urgency': 'high'}))
+
+
+class PagerParrotIncidentIndexTest(unittest.TestCase):
+    def setUp(self):
+        super(PagerParrotIncidentIndexTest, self).setUp()
+        patcher = mock.patch.dict(pager_parrot._incident_messages, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_record_and_forget(self):
+        pager_parrot.record_incident_message('P1', 'C1', '1.1', 'hi')
+        pager_parrot.record_incident_message('P1', 'C2', '2.2', 'hey')
+        self.assertEqual(pager_parrot.incident_messages('P1'),
+                         [('C1', '1.1', 'hi'), ('C2', '2.2', 'hey')])
+        pager_parrot.forget_incident_messages('P1')
+        self.assertEqual(pager_parrot.incident_messages('P1'), [])
+
+    def test_bounded(self):
+        with mock.patch('pager_parrot._MAX_TRACKED_INCIDENTS', 2):
+            for incident_id in ('P1', 'P2', 'P3'):
+                pager_parrot.record_incident_message(
+                    incident_id, 'C1', '1.1', 'hi')
+        self.assertEqual(pager_parrot.incident_messages('P1'), [])
+        self.assertEqual(len(pager_parrot.incident_messages('P3')), 1)
+
+    def test_format_status_update(self):
+        self.assertEqual(
+            pager_parrot.format_status_update(
+                'Oh no!', 'incident.resolve',
+                {'last_status_change_by': {'name': 'Kamens'}}),
+            'Oh no!\n*Resolved by Kamens*')
+
+
+class PagerParrotHandlerTest(unittest.TestCase):
+    def setUp(self):
+        super(PagerParrotHandlerTest, self).setUp()
+        for patcher in [
+                mock.patch.dict(pager_parrot._incident_messages, clear=True),
+                mock.patch('main.pagerduty_ids_seen', set()),
+                mock.patch('pager_parrot.channels_for_incident',
+                           return_value={'#1s-and-0s'}),
+                mock.patch('pager_parrot.format_message',
+                           return_value='Oh no!'),
+                mock.patch('pager_parrot.consider_ping', return_value=True),
+                mock.patch('pager_parrot.set_channel_thread'),
+                mock.patch('main._update_slack_message'),
+                mock.patch('main._send_to_slack')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        main._send_to_slack.return_value.json.return_value = {
+            'ok': True, 'channel': 'C1', 'ts': '1.1'}
+
+    def _post(self, message_id, message_type):
+        request = webapp2.Request.blank('/pagerduty-feed')
+        request.method = 'POST'
+        request.body = json.dumps({'messages': [{
+            'id': message_id,
+            'type': message_type,
+            'data': {'incident': {'id': 'PINCIDENT'}},
+        }]})
+        return request.get_response(main.app)
+
+    def test_lifecycle_updates_in_place(self):
+        self._post('1', 'incident.trigger')
+        self._post('2', 'incident.acknowledge')
+        self._post('3', 'incident.resolve')
+        self._post('4', 'incident.resolve')
+        self.assertEqual(main._send_to_slack.call_count, 1)
+        self.assertEqual(
+            [c[0] for c in main._update_slack_message.call_args_list],
+            [('Oh no!\n*Acknowledged*', 'C1', '1.1'),
+             ('Oh no!\n*Resolved*', 'C1', '1.1')])
+        self.assertEqual(pager_parrot.incident_messages('PINCIDENT'), [])
+
+    def test_failed_resolve_kept_for_retry(self):
+        pager_parrot.record_incident_message('PINCIDENT', 'C1', '1.1', 'a')
+        pager_parrot.record_incident_message('PINCIDENT', 'C2', '2.2', 'b')
+        main._update_slack_message.side_effect = [
+            RuntimeError('slow'), mock.DEFAULT,
+            mock.DEFAULT, mock.DEFAULT]
+        self.assertEqual(self._post('1', 'incident.resolve').status_int, 500)
+        # We still updated the other channel, and remember both for the
+        # retry.
+        self.assertEqual(main._update_slack_message.call_count, 2)
+        self.assertEqual(len(pager_parrot.incident_messages('PINCIDENT')), 2)
+        self.assertEqual(self._post('1', 'incident.resolve').status_int, 200)
+        self.assertEqual(main._update_slack_message.call_count, 4)
+        self.assertEqual(pager_parrot.incident_messages('PINCIDENT'), [])
+
+
+class PagerParrotReloadTest(unittest.TestCase):
+    def test_reload_during_incident(self):
+        channels = {'#a': pager_parrot.Configuration(
+            channel_type=pager_parrot._FIRST_PARTY,
+            high_priority_action=pager_parrot._PING_WITH_AT_CHANNEL,
+            medium_priority_action=pager_parrot._PING_WITH_AT_HERE,
+            low_priority_action=pager_parrot._SUPPRESS_PING)}
+        before = pager_parrot.Routing(channels, *pager_parrot.compile_routes(
+            [pager_parrot.Route(channels={'#a'})], channels))
+        after = pager_parrot.Routing({}, *pager_parrot.compile_routes([], {}))
+        for patcher in [
+                mock.patch.object(pager_parrot._routing, 'get',
+                                  side_effect=[before] + [after] * 10),
+                mock.patch('main.pagerduty_ids_seen', set()),
+                mock.patch('pager_parrot.consider_ping', return_value=True),
+                mock.patch('main._send_to_slack'),
+                _mocking_weekday()]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        main._send_to_slack.return_value.json.return_value = {
+            'ok': True, 'channel': 'C1', 'ts': '1.1'}
+
+        request = webapp2.Request.blank('/pagerduty-feed')
+        request.method = 'POST'
+        request.body = json.dumps({'messages': [{
+            'id': '1',
+            'type': 'incident.trigger',
+            'data': {'incident': {
+                'id': 'PINCIDENT', 'urgency': 'high',
+                'html_url': 'https://example.com', 'incident_number': 1}},
+        }]})
+        response = request.get_response(main.app)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(main._send_to_slack.call_count, 1)
+        self.assertEqual(channels['#a'].previous_thread_id, '1.1')
+
+
 def _mocking_day_of_week(weekday):
     """Set the current time to the given day of the week; 0 = Monday."""
     base_monday = datetime.datetime(2016, 7, 4, 12, 22, 0)
@@ -0,0 +1,135 @@
+"""Run slow outbound calls concurrently, and hedge the slowest of them.
+
+`start()` runs a function on its own thread and returns a handle whose
+`result()` waits for it.  The `hedged()` decorator is for idempotent reads:
+if a call is taking longer than 95% of recent calls to the same function, we
+fire off a second identical call and take whichever answers first.  That cuts
+off the long tail from a single slow Phabricator web node without adding much
+load, since by definition it only happens about one time in twenty.
+
+Both carry the caller's deadline (see deadline.py), trace span (see
+tracing.py) and profiler sampling (see profiler.py) over to the new threads.
+"""
+import collections
+import functools
+import logging
+import Queue
+import sys
+import threading
+import time
+
+import deadline
+import memory
+import profiler
+import tracing
+
+
+# We hedge calls that have taken longer than this percentile of recent ones.
+_HEDGE_PERCENTILE = 95
+
+# How many recent latencies to remember per function, and how many we need
+# before we trust the percentile enough to hedge on it.
+_LATENCY_SAMPLES = 200
+_MIN_LATENCY_SAMPLES = 20
+
+
+class _Call(object):
+    """A function call running on its own thread."""
+    def __init__(self, func, args, kwargs, finished=None):
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs
+        # A Queue to put ourselves on when we're done, if any.
+        self._finished = finished
+        self._done = threading.Event()
+        self._deadline = deadline.current()
+        self._span = tracing.current_span()
+        self._sampling = profiler.current_sampling()
+        self.value = None
+        self.exc_info = None
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        with deadline.installed(self._deadline), \
+                tracing.installed(self._span), \
+                profiler.installed(self._sampling):
+            try:
+                self.value = self._func(*self._args, **self._kwargs)
+            except Exception:
+                self.exc_info = sys.exc_info()
+        self._done.set()
+        if self._finished is not None:
+            self._finished.put(self)
+
+    def result(self):
+        """Wait for the call to finish, and return or raise what it did."""
+        self._done.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+
+def start(func, *args, **kwargs):
+    """Start calling func(*args, **kwargs) in the background."""
+    return _Call(func, args, kwargs)
+
+
+class _LatencyTracker(object):
+    def __init__(self):
+        self._samples = collections.deque(maxlen=_LATENCY_SAMPLES)
+
+    def record(self, seconds):
+        self._samples.append(seconds)
+
+    def percentile(self, percent):
+        """Return the given percentile of recent latencies, or None if we
+        haven't seen enough calls to say."""
+        samples = sorted(self._samples)
+        if len(samples) < _MIN_LATENCY_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, len(samples) * percent // 100)]
+
+
+# Map from function name to _LatencyTracker.
+_latencies = collections.defaultdict(_LatencyTracker)
+memory.register('parallel.latencies', lambda: _latencies)
+
+
+def hedged(name):
+    """Decorator for idempotent reads that may be retried while in flight.
+
+    `name` identifies the function for the purposes of latency tracking.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tracker = _latencies[name]
+            hedge_after = tracker.percentile(_HEDGE_PERCENTILE)
+            finished = Queue.Queue()
+            start = time.time()
+            _Call(func, args, kwargs, finished)
+            pending = 1
+            try:
+                call = finished.get(timeout=hedge_after)
+            except Queue.Empty:
+                logging.info("Hedging %s after %.3fs" % (name, hedge_after))
+                _Call(func, args, kwargs, finished)
+                pending += 1
+                call = finished.get()
+            pending -= 1
+
+            # If the first answer was an error, give the other call a chance.
+            while call.exc_info and pending:
+                call = finished.get()
+                pending -= 1
+
+            # We record how long our caller waited, not how long the winning
+            # call took: a hedge that wins started late, so its own time
+            # would make the percentile drift down.
+            if not call.exc_info:
+                tracker.record(time.time() - start)
+            return call.result()
+        return wrapper
+    return decorator
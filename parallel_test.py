@@ -0,0 +1,92 @@
+import threading
+import unittest
+
+import mock
+
+import deadline
+import parallel
+
+
+class StartTest(unittest.TestCase):
+    def test_result(self):
+        self.assertEqual(parallel.start(lambda x, y: x + y, 1, y=2).result(),
+                         3)
+
+    def test_exception(self):
+        def fail():
+            raise KeyError('oops')
+        self.assertRaises(KeyError, parallel.start(fail).result)
+
+    def test_deadline_carried_over(self):
+        with deadline.started(50) as d:
+            self.assertIs(parallel.start(deadline.current).result(), d)
+
+
+class HedgedTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(parallel._latencies, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _train(self, name, seconds):
+        for _ in xrange(parallel._MIN_LATENCY_SAMPLES):
+            parallel._latencies[name].record(seconds)
+
+    def test_no_hedge_without_history(self):
+        calls = []
+
+        @parallel.hedged('test.read')
+        def read():
+            calls.append(1)
+            return 'result'
+
+        self.assertEqual(read(), 'result')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(parallel._latencies['test.read'].percentile(95),
+                         None)
+
+    def test_slow_call_is_hedged(self):
+        self._train('test.read', 0.01)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        calls = []
+
+        @parallel.hedged('test.read')
+        def read():
+            calls.append(1)
+            if len(calls) == 1:
+                release.wait()
+                return 'slow'
+            return 'fast'
+
+        self.assertEqual(read(), 'fast')
+        self.assertEqual(len(calls), 2)
+        # We record the time until the hedge answered, not just its own.
+        self.assertGreaterEqual(
+            parallel._latencies['test.read']._samples[-1], 0.01)
+
+    def test_failed_hedge_falls_back_to_other_call(self):
+        self._train('test.read', 0.01)
+        release = threading.Event()
+        calls = []
+
+        @parallel.hedged('test.read')
+        def read():
+            calls.append(1)
+            if len(calls) == 1:
+                release.wait()
+                return 'slow'
+            release.set()
+            raise IOError('oops')
+
+        self.assertEqual(read(), 'slow')
+
+    def test_percentile(self):
+        tracker = parallel._LatencyTracker()
+        for i in xrange(100):
+            tracker.record(i)
+        self.assertEqual(tracker.percentile(95), 95)
+
+
+if __name__ == '__main__':
+    unittest.main()
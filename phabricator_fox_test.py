@@ -7,7 +7,17 @@ import mock
 import webapp2
 import json
 
+from google.appengine.ext import testbed
+
+import config_file
+import deadline
+import dedupe
+import digest
+import diff_index
+import pager_parrot
 import phabricator_fox
+import tracing
+import user_index
 
 
 # These example strings were taken from the logs of
@@ -30,6 +40,19 @@ class PhabFoxLogicTest(unittest.TestCase):
 
 class TestPhabricatorFoxHandlers(unittest.TestCase):
     def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.addCleanup(self.testbed.deactivate)
+        diff_index._index.clear()
+        self.addCleanup(diff_index._index.clear)
+        self.mock_function('main._refresh_user_index')
+        self._activate_patcher(mock.patch('main._user_index_retry_at', 0))
+        self.mock_function('main._send_fox_message')
+        self.mock_function('main._callsigns_from_repo_urls',
+                           return_value=set())
+
         self.mock_send_to_slack = self.mock_function(
             'main._build_slack_message', return_value="test message")
         self.args = json.dumps({
@@ -129,6 +152,346 @@ class TestPhabricatorFoxHandlers(unittest.TestCase):
         self.assertEqual(
             self.mock_send_to_slack.call_args_list[0][0][1], 'abandon')
 
+    def test_transaction_pages_followed_lazily(self):
+        self.args = json.dumps({
+            'object': {'phid': 'PHID-object'},
+            'transactions': [{'phid': 'PHID-1'}, {'phid': 'PHID-2'}],
+        })
+        mock_search = self.mock_function(
+            'main._transaction_search_from_phids', side_effect=[
+                {'data': [{'phid': 'PHID-1', 'type': 'comment'}],
+                 'cursor': {'after': '1'}},
+                {'data': [{'phid': 'PHID-2', 'type': 'create',
+                           'authorPHID': 'PHID-user'}],
+                 'cursor': {'after': '2'}},
+            ])
+        self.mock_function('main._phid_query_from_phid', return_value={
+            "PHID-test": {
+                "phid": "PHID-test",
+                "uri": "https://test",
+                "name": "D123",
+                "fullName": "D123: test",
+                "status": "open"}})
+        self.mock_function(
+            'main._get_author_username', return_value="test user")
+        self.mock_function(
+            'main._repository_phid_from_diff_id', return_value=None)
+        response = self._get_response(self.args)
+        self.assertEqual(response.status_int, 200)
+        # We've seen both transactions after the second page, so we don't
+        # follow its cursor.
+        self.assertEqual(mock_search.call_count, 2)
+        self.assertEqual(mock_search.call_args_list[1][1], {'after': '1'})
+        self.assertEqual(self.mock_send_to_slack.call_count, 1)
+        self.assertEqual(
+            self.mock_send_to_slack.call_args_list[0][0][1], 'create')
+
+    def test_budget_used_up_before_first_page(self):
+        # Leave only the reserve, so every non-critical call is refused.
+        self._activate_patcher(
+            mock.patch('main._REQUEST_BUDGET', main._CRITICAL_RESERVE))
+        response = self._get_response(self.args)
+        self.assertEqual(response.status_int, 503)
+        self.assertEqual(self.mock_send_to_slack.call_count, 0)
+
+    def test_budget_used_up_skips_optional_lookups(self):
+        # Leave only the reserve, so every non-critical call is refused.
+        self._activate_patcher(
+            mock.patch('main._REQUEST_BUDGET', main._CRITICAL_RESERVE))
+        search = main._transaction_search_from_phids
+
+        def first_page_only(phid, phid_map, after=None):
+            if after:
+                return search(phid, phid_map, after=after)
+            return {'data': [{'phid': 'PHID-other', 'type': 'create',
+                              'authorPHID': 'PHID-user'}],
+                    'cursor': {'after': '1'}}
+
+        mock_search = self.mock_function(
+            'main._transaction_search_from_phids', side_effect=first_page_only)
+        mock_phabricator = self._activate_patcher(
+            mock.patch('main.phabricator.Phabricator'))
+        mock_phabricator.return_value.phid.phid.query.return_value = (
+            mock.Mock(response={"PHID-test": {
+                "phid": "PHID-test",
+                "uri": "https://test",
+                "name": "D123",
+                "fullName": "D123: test",
+                "status": "open"}}))
+        response = self._get_response(self.args)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(mock_search.call_count, 2)
+        # We can't post without the phid info, so we look that up anyway,
+        # but skip the repo and author lookups.
+        self.assertEqual(mock_phabricator.call_count, 1)
+        self.assertEqual(self.mock_send_to_slack.call_count, 1)
+        self.assertEqual(self.mock_send_to_slack.call_args[0][2], 'PHID-user')
+        self.assertEqual(main._send_fox_message.call_count, 1)
+
+    def test_known_diff_needs_no_repository_lookup(self):
+        diff_index.put(123, 'PHID-REPO-1', 'GWA')
+        mock_repo_lookup = self.mock_function(
+            'main._repository_phid_from_diff_id')
+        self.assertEqual(main._callsign_from_diff_id(123), 'GWA')
+        self.assertEqual(mock_repo_lookup.call_count, 0)
+
+    def test_unknown_diff_is_recorded(self):
+        self.mock_function(
+            'main._repository_phid_from_diff_id', return_value='PHID-REPO-1')
+        self.mock_function(
+            'main._callsign_from_repository_phid', return_value='GWA')
+        self.assertEqual(main._callsign_from_diff_id(123), 'GWA')
+        self.assertEqual(diff_index.get(123), ('PHID-REPO-1', 'GWA'))
+
+    def test_author_mentioned_from_user_index(self):
+        user_index.replace(
+            [{'phid': 'PHID-user', 'fields': {'username': 'dhruv'}}],
+            [{'id': 'U1', 'profile': {'email': 'dhruv@khanacademy.org'}}])
+        self.addCleanup(setattr, user_index, '_snapshot', ({}, {}, None))
+        mock_username = self.mock_function('main._get_author_username')
+        self.assertEqual(main._author_from_phid('PHID-user'),
+                         ('dhruv', '<@U1>'))
+        self.assertEqual(mock_username.call_count, 0)
+
+    def test_failed_user_index_load_not_retried_every_message(self):
+        main._refresh_user_index.side_effect = RuntimeError('missing_scope')
+        self.mock_function('main._get_author_username', return_value='dhruv')
+        for _ in xrange(3):
+            self.assertEqual(main._author_from_phid('PHID-user'),
+                             ('dhruv', 'dhruv'))
+        self.assertEqual(main._refresh_user_index.call_count, 1)
+
+        main._user_index_retry_at = 0
+        main._author_from_phid('PHID-user')
+        self.assertEqual(main._refresh_user_index.call_count, 2)
+
+
+class UserListTest(unittest.TestCase):
+    def test_each_page_gets_a_timeout(self):
+        pages = [
+            {'ok': True, 'members': [{'id': 'U1'}],
+             'response_metadata': {'next_cursor': 'next'}},
+            {'ok': True, 'members': [{'id': 'U2'}]},
+        ]
+        with mock.patch('main._slack_session') as session, \
+                deadline.installed(deadline.Deadline(50, 15)):
+            session.get.return_value.json.side_effect = pages
+            self.assertEqual([m['id'] for m in main._iter_slack_users()],
+                             ['U1', 'U2'])
+        for call in session.get.call_args_list:
+            self.assertLessEqual(call[1]['timeout'], 35)
+
+    def test_budget_checked_each_page(self):
+        pages = [
+            {'data': [{'phid': 'PHID-USER-1'}], 'cursor': {'after': '1'}},
+            {'data': [{'phid': 'PHID-USER-2'}], 'cursor': {}},
+        ]
+        with mock.patch('main._get_phabricator') as get_phabricator:
+            get_phabricator.return_value.phid.user.search.side_effect = [
+                mock.Mock(response=page) for page in pages]
+            self.assertEqual(len(list(main._iter_phabricator_users())), 2)
+        self.assertEqual(get_phabricator.call_count, 2)
+
+
+class SlackDedupeTest(unittest.TestCase):
+    def setUp(self):
+        for patcher in [
+                mock.patch('main._slack_dedupe', dedupe.Dedupe(600)),
+                mock.patch('main._slack_session'),
+                mock.patch('main._fox_digest')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_repeated_post_skipped(self):
+        self.assertIsNotNone(main._send_to_slack('hi', '#a', 'Fox', ':fox:'))
+        self.assertIsNone(main._send_to_slack('hi', '#a', 'Fox', ':fox:'))
+        self.assertIsNotNone(main._send_to_slack('hi', '#b', 'Fox', ':fox:'))
+        self.assertEqual(main._slack_session.post.call_count, 2)
+
+    def test_no_dedupe(self):
+        main._slack_dedupe = None
+        main._send_to_slack('hi', '#a', 'Fox', ':fox:')
+        main._send_to_slack('hi', '#a', 'Fox', ':fox:')
+        self.assertEqual(main._slack_session.post.call_count, 2)
+
+    def test_failed_post_not_a_repeat(self):
+        main._slack_session.post.side_effect = [IOError('Slack is down'),
+                                                mock.Mock()]
+        self.assertRaises(IOError, main._send_to_slack,
+                          'hi', '#a', 'Fox', ':fox:')
+        self.assertIsNotNone(main._send_to_slack('hi', '#a', 'Fox', ':fox:'))
+        self.assertEqual(main._slack_session.post.call_count, 2)
+
+    def test_rejected_post_not_a_repeat(self):
+        main._slack_session.post.return_value.json.return_value = {
+            'ok': False, 'error': 'ratelimited'}
+        main._send_to_slack('hi', '#a', 'Fox', ':fox:')
+        main._send_to_slack('hi', '#a', 'Fox', ':fox:')
+        self.assertEqual(main._slack_session.post.call_count, 2)
+
+    def test_failed_digest_post_not_a_repeat(self):
+        main._fox_digest = digest.Digest(
+            main._send_fox_digest, window=30, max_size=10,
+            start_thread=mock.Mock(), on_failure=main._forget_fox_digest)
+        main._slack_session.post.side_effect = IOError('Slack is down')
+        main._send_fox_message('D123 created', '#a')
+        with mock.patch('digest._MAX_ATTEMPTS', 1):
+            main._fox_digest.flush()
+        main._send_fox_message('D123 created', '#a')
+        self.assertEqual(main._fox_digest.size(), 1)
+
+    def test_rate_limited_digest_post_retried(self):
+        main._slack_session.post.return_value.status_code = 429
+        main._slack_session.post.return_value.headers = {'Retry-After': '60'}
+        with self.assertRaises(digest.RetryLater) as cm:
+            main._send_fox_digest('#a', 'D123 created')
+        self.assertEqual(cm.exception.seconds, 60)
+
+    def test_repeated_fox_message_not_digested(self):
+        main._send_fox_message('D123 created', '#a')
+        main._send_fox_message('D123  created', '#a')
+        self.assertEqual(main._fox_digest.add.call_count, 1)
+
+    def test_no_digest(self):
+        main._fox_digest = None
+        main._send_fox_message('D123 created', '#a')
+        self.assertEqual(main._slack_session.post.call_count, 1)
+        response = webapp2.Request.blank('/_ah/stop').get_response(main.app)
+        self.assertEqual(response.status_int, 200)
+
+
+class SlackTimingTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.exported = []
+        for patcher in [
+                mock.patch('time.time', lambda: self.now),
+                mock.patch('main._slack_dedupe', dedupe.Dedupe(600)),
+                mock.patch('main._slack_session'),
+                mock.patch('tracing._exporter', self.exported.extend),
+                mock.patch('tracing._SAMPLE_RATE', 1)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _slow_post(self, *args, **kwargs):
+        self.now += 2
+        return mock.Mock()
+
+    def test_post_is_timed_and_traced(self):
+        main._slack_session.post.side_effect = self._slow_post
+        with deadline.started(50) as d, tracing.trace('/request'):
+            main._send_to_slack('hi', '#a', 'Fox', ':fox:')
+        tracing.export()
+        self.assertEqual(d.stage_times['slack'], 2)
+        spans = {span['name']: span for span in self.exported}
+        self.assertEqual(spans['slack.chat.postMessage']['duration'], 2)
+
+
+class RoutingTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch(
+            'main._callsigns_from_repo_urls',
+            side_effect=lambda urls: {urls[0].rsplit('/', 1)[1].upper()})
+        self.lookup = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.config = {
+            'github_channels': {'webapp': ['#a']},
+            'user_channels': {'dhruv': ['#b']},
+        }
+
+    def test_build(self):
+        routing = main._build_routing(self.config, None)
+        self.assertEqual(routing.callsign_channels, {'WEBAPP': {'#a'}})
+        self.assertEqual(routing.user_channels, {'dhruv': {'#b'}})
+
+    def test_only_new_repos_looked_up(self):
+        old = main._build_routing(self.config, None)
+        self.config['github_channels'] = {'webapp': ['#c'], 'perseus': ['#d']}
+        new = main._build_routing(self.config, old)
+        self.assertEqual(self.lookup.call_count, 2)
+        self.assertEqual(self.lookup.call_args[0][0],
+                         ['git@github.com:Khan/perseus'])
+        self.assertEqual(new.callsign_channels,
+                         {'WEBAPP': {'#c'}, 'PERSEUS': {'#d'}})
+
+    def test_failed_lookup_tried_again(self):
+        self.config['github_channels']['perseus'] = ['#d']
+        self.lookup.side_effect = IOError('Phabricator is down')
+        old = main._build_routing(self.config, None)
+        self.assertEqual(old.callsign_channels, {})
+        # We stop trying after the first failure.
+        self.assertEqual(self.lookup.call_count, 1)
+        del self.config['github_channels']['perseus']
+        self.lookup.side_effect = None
+        self.lookup.return_value = {'GWA'}
+        new = main._build_routing(self.config, old)
+        self.assertEqual(new.callsign_channels, {'GWA': {'#a'}})
+
+
+class RoutingConfigTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.addCleanup(self.testbed.deactivate)
+        for patcher in [
+                mock.patch('main._callsigns_from_repo_urls',
+                           return_value=set()),
+                mock.patch.object(main._routing, 'reload'),
+                mock.patch.object(pager_parrot._routing, 'reload')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        with open(config_file.PATH) as f:
+            self.config = json.load(f)
+
+    def _put(self, body):
+        request = webapp2.Request.blank('/admin/routing')
+        request.method = 'PUT'
+        request.body = body
+        return request.get_response(main.app)
+
+    def test_save(self):
+        self.config['user_channels']['dhruv'] = ['#new-channel']
+        body = json.dumps(self.config)
+        response = self._put(body)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(config_file.current_text(config_file.PATH), body)
+        self.assertEqual(main._routing.reload.call_count, 1)
+        self.assertEqual(pager_parrot._routing.reload.call_count, 1)
+        response = webapp2.Request.blank('/admin/routing').get_response(
+            main.app)
+        self.assertEqual(json.loads(response.body), self.config)
+
+    def test_bad_config_not_saved(self):
+        del self.config['pager_parrot']
+        for body in ('{not json', json.dumps(self.config)):
+            self.assertEqual(self._put(body).status_int, 400)
+        self.assertIsNone(config_file._stored(config_file.PATH))
+        self.assertEqual(main._routing.reload.call_count, 0)
+
+
+class WarmupTest(unittest.TestCase):
+    def test_warmup_reports_every_step(self):
+        patchers = [
+            mock.patch('pager_parrot.load_timezone'),
+            mock.patch('main._slack_session'),
+            mock.patch('main._get_phabricator'),
+            mock.patch('main._refresh_user_index',
+                       side_effect=IOError('Slack is down')),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        response = webapp2.Request.blank('/_ah/warmup').get_response(
+            main.app)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(
+            [line.split(':')[0] for line in response.body.splitlines()],
+            ['phabricator-connection', 'routing', 'slack-connection',
+             'timezone', 'user-index'])
+        self.assertEqual(pager_parrot.load_timezone.call_count, 1)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,185 @@
+"""An on-demand sampling profiler for request handlers.
+
+While a request is being profiled, a helper thread looks at the stacks of
+the request thread, and of any threads it starts with parallel.py, every few
+milliseconds and counts how often each stack shows up.  The counts are kept
+in instance memory in "collapsed" form (one line per stack, frames separated
+by semicolons, then the count), which is what flamegraph.pl and speedscope
+read.
+
+Profiling is off unless a request sends the PROFILE_HEADER set to our shared
+secret, or an admin has turned it on for every request for a while with
+profile_all_for().  When it's off, it costs one check per request.
+"""
+import collections
+import contextlib
+import hmac
+import os
+import sys
+import threading
+import time
+
+import memory
+
+
+# Send this header (with any value) to profile a single request.
+PROFILE_HEADER = 'X-Khan-Webhooks-Profile'
+
+# How often to sample the stack while profiling.
+_SAMPLE_INTERVAL = 0.005
+
+# How many distinct stacks to keep counts for; samples of any further stacks
+# are lumped together.
+_MAX_STACKS = 2000
+_OTHER_STACK = '[other]'
+
+# The time until which we profile every request, if any.
+_profile_all_until = None
+
+
+def profile_all_for(seconds):
+    """Profile every request for the next `seconds`; 0 turns it back off."""
+    global _profile_all_until
+    _profile_all_until = time.time() + seconds if seconds > 0 else None
+
+
+def wanted(headers, secret=None):
+    """Whether to profile a request with the given headers.
+
+    We only honor the PROFILE_HEADER if its value is `secret`, so that
+    strangers can't slow down our requests; without a secret, we ignore it.
+    """
+    if _profile_all_until is not None and time.time() < _profile_all_until:
+        return True
+    return bool(secret) and hmac.compare_digest(
+        str(headers.get(PROFILE_HEADER, '')), str(secret))
+
+
+class _Aggregate(object):
+    def __init__(self):
+        self._counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    def add(self, stack):
+        with self._lock:
+            if stack not in self._counts and len(self._counts) >= _MAX_STACKS:
+                stack = _OTHER_STACK
+            self._counts[stack] += 1
+
+    def collapsed(self):
+        """Return the samples as flamegraph-ready lines."""
+        with self._lock:
+            return ['%s %s' % (stack, count)
+                    for stack, count in sorted(self._counts.items())]
+
+    def top_functions(self, n):
+        """Return the n functions most often at the top of the stack, as a
+        list of (function, samples)."""
+        leaves = collections.Counter()
+        with self._lock:
+            for stack, count in self._counts.items():
+                leaves[stack.rsplit(';', 1)[-1]] += count
+        return leaves.most_common(n)
+
+    def total(self):
+        with self._lock:
+            return sum(self._counts.values())
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
+
+
+_samples = _Aggregate()
+memory.register('profiler.samples', lambda: _samples._counts)
+
+
+def _collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s:%s' % (os.path.basename(code.co_filename),
+                                code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+_local = threading.local()
+
+
+def current_sampling():
+    """Return the sampling() this thread's stack is part of, or None."""
+    return getattr(_local, 'sampling', None)
+
+
+@contextlib.contextmanager
+def installed(sampler):
+    """Sample this thread's stack as part of `sampler`, a sampling() or
+    None, while in this block.
+
+    Code that hands work to other threads should pass current_sampling()
+    along and run the work inside this, so the time it spends shows up.
+    """
+    previous = current_sampling()
+    _local.sampling = sampler
+    thread_id = threading.current_thread().ident
+    if sampler is not None:
+        sampler._add(thread_id)
+    try:
+        yield sampler
+    finally:
+        if sampler is not None:
+            sampler._remove(thread_id)
+        _local.sampling = previous
+
+
+class sampling(object):
+    """Context manager that samples the current thread's stack while in it,
+    along with the stacks of any threads it installs itself on."""
+    def __enter__(self):
+        self._thread_ids = set([threading.current_thread().ident])
+        self._lock = threading.Lock()
+        self._previous = current_sampling()
+        _local.sampling = self
+        self._done = threading.Event()
+        self._sampler = threading.Thread(target=self._sample)
+        self._sampler.daemon = True
+        self._sampler.start()
+
+    def __exit__(self, *exc_info):
+        self._done.set()
+        self._sampler.join()
+        _local.sampling = self._previous
+
+    def _add(self, thread_id):
+        with self._lock:
+            self._thread_ids.add(thread_id)
+
+    def _remove(self, thread_id):
+        with self._lock:
+            self._thread_ids.discard(thread_id)
+
+    def _sample(self):
+        while not self._done.wait(_SAMPLE_INTERVAL):
+            with self._lock:
+                thread_ids = list(self._thread_ids)
+            frames = sys._current_frames()
+            for thread_id in thread_ids:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    _samples.add(_collapse(frame))
+
+
+def report(top_n=20):
+    """Return a plain-text report: the top functions, then every stack."""
+    total = _samples.total()
+    lines = ['# %s samples; top %s functions:' % (total, top_n)]
+    for function, count in _samples.top_functions(top_n):
+        lines.append('# %6.2f%% %s' % (100.0 * count / total, function))
+    lines.append('')
+    lines.extend(_samples.collapsed())
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    _samples.clear()
@@ -0,0 +1,59 @@
+import time
+import unittest
+
+import mock
+
+import parallel
+import profiler
+
+
+def _busy_for(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+class ProfilerTest(unittest.TestCase):
+    def setUp(self):
+        profiler.reset()
+        self.addCleanup(profiler.reset)
+        self.addCleanup(profiler.profile_all_for, 0)
+
+    def test_sampling(self):
+        with profiler.sampling():
+            _busy_for(0.1)
+        report = profiler.report(top_n=1)
+        self.assertIn('profiler_test.py:_busy_for', report.splitlines()[1])
+        self.assertIn(
+            'profiler_test.py:test_sampling;profiler_test.py:_busy_for',
+            report)
+
+    def test_sampling_worker_threads(self):
+        with profiler.sampling():
+            parallel.start(_busy_for, 0.1).result()
+        report = profiler.report(top_n=1)
+        self.assertIn('profiler_test.py:_busy_for', report.splitlines()[1])
+        self.assertIn('parallel.py:_run;profiler_test.py:_busy_for', report)
+
+    def test_bounded(self):
+        with mock.patch('profiler._MAX_STACKS', 2):
+            for stack in ('a;b', 'a;c', 'a;d', 'a;b'):
+                profiler._samples.add(stack)
+        self.assertEqual(profiler._samples.collapsed(),
+                         ['[other] 1', 'a;b 2', 'a;c 1'])
+
+    def test_wanted(self):
+        self.assertFalse(profiler.wanted({}))
+        self.assertTrue(profiler.wanted({profiler.PROFILE_HEADER: 'shh'},
+                                        'shh'))
+        self.assertFalse(profiler.wanted({profiler.PROFILE_HEADER: '1'},
+                                         'shh'))
+        self.assertFalse(profiler.wanted({profiler.PROFILE_HEADER: ''}))
+        profiler.profile_all_for(60)
+        self.assertTrue(profiler.wanted({}))
+        profiler.profile_all_for(0)
+        self.assertFalse(profiler.wanted({}))
+
+
+if __name__ == '__main__':
+    unittest.main()
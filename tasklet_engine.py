@@ -0,0 +1,492 @@
+"""A second engine that handles webhook deliveries as ndb tasklets.
+
+The handlers in main.py make their outbound calls one at a time with blocking
+HTTP, so each delivery in flight holds a thread for several round trips.
+Here the same deliveries run as tasklets (App Engine's coroutines) over
+urlfetch's non-blocking RPCs, so a single thread can keep hundreds of them in
+flight at once: whenever one is waiting on Phabricator or Slack, the others
+carry on.  urlfetch pools the underlying connections for us.
+
+The parsing, routing and message formatting all come from main.py and
+pager_parrot.py, as do the Phabricator lookups (see main._run_steps); only
+the outbound calls themselves are re-done here, as tasklets.  This
+handles the new Phabricator feed and PagerDuty, not the legacy
+/phabricator-feed.  Call handle_many() with a list of (kind, payload) pairs,
+where kind is 'phabricator' or 'pagerduty' and payload is the parsed JSON
+body of the webhook.
+
+Deliveries handled together share their lookups: if ten deliveries are about
+the same diff, or by the same author, we only ask Phabricator once.
+"""
+import functools
+import hashlib
+import json
+import logging
+import sys
+import threading
+import time
+import urllib
+
+from google.appengine.ext import ndb
+
+import deadline
+import main
+import pager_parrot
+import user_index
+
+
+# How many deliveries handle_many() runs at once.
+_MAX_IN_FLIGHT = 200
+
+# The longest we'll wait when Slack asks us to slow down, if it doesn't say.
+_DEFAULT_RETRY_AFTER = 1.0
+
+# While handle_many() runs a batch on this thread, `lookups` is a dict from
+# (function name, args) to the Future for that lookup, `incidents` is a dict
+# from PagerDuty incident ID to the Future for the last work on it, and
+# `pagerduty_ids` is the set of PagerDuty message IDs we've started on.
+_batch = threading.local()
+
+
+def _shared(func):
+    """Decorator for lookup tasklets that every delivery in a handle_many()
+    batch can share."""
+    @functools.wraps(func)
+    def wrapper(*args):
+        lookups = getattr(_batch, 'lookups', None)
+        if lookups is None:
+            return func(*args)
+        key = (func.__name__,) + args
+        if key not in lookups:
+            lookups[key] = func(*args)
+        return lookups[key]
+    return wrapper
+
+
+class ConduitError(Exception):
+    pass
+
+
+class SlackError(Exception):
+    pass
+
+
+@ndb.tasklet
+def _conduit_request_async(method, params, critical=False):
+    resp = yield ndb.get_context().urlfetch(
+        '%s/api/%s' % (main.PHABRICATOR_HOST, method),
+        payload=urllib.urlencode({
+            'params': json.dumps(params),
+            'output': 'json',
+        }),
+        method='POST',
+        headers={'Content-Type': 'application/x-www-form-urlencoded'},
+        deadline=deadline.current().timeout(critical=critical))
+    if not 200 <= resp.status_code < 300:
+        raise ConduitError("%s returned HTTP %s" % (method, resp.status_code))
+    data = json.loads(resp.content)
+    if data['error_code']:
+        raise ConduitError("%s: %s: %s" % (
+            method, data['error_code'], data['error_info']))
+    raise ndb.Return(data['result'])
+
+
+# Our conduit session, once we've connected: the same thing python-phabricator
+# sends as `__conduit__`.
+_conduit_session = None
+
+
+@ndb.tasklet
+def _connect_async(critical=False):
+    global _conduit_session
+    token = str(int(time.time()))
+    result = yield _conduit_request_async('conduit.connect', {
+        'user': main.PHABRICATOR_USERNAME,
+        'host': main.PHABRICATOR_HOST + '/api/',
+        'client': 'khan-webhooks',
+        'clientVersion': 1,
+        'authToken': token,
+        'authSignature': hashlib.sha1(
+            token + main.secrets.phabricator_certificate).hexdigest(),
+    }, critical=critical)
+    _conduit_session = {
+        'sessionKey': result['sessionKey'],
+        'connectionID': result['connectionID'],
+    }
+    raise ndb.Return(_conduit_session)
+
+
+@ndb.tasklet
+def conduit_async(method, critical=False, **params):
+    """Call a conduit method, like phabricator.Phabricator does.
+
+    Like main._get_phabricator, non-critical calls aren't made once only
+    the reserve is left.
+    """
+    session = _conduit_session
+    if session is None:
+        session = yield _connect_async(critical)
+    try:
+        result = yield _conduit_request_async(
+            method, dict(params, __conduit__=session), critical)
+    except ConduitError as e:
+        if 'ERR-INVALID-SESSION' not in str(e):
+            raise
+        session = yield _connect_async(critical)
+        result = yield _conduit_request_async(
+            method, dict(params, __conduit__=session), critical)
+    raise ndb.Return(result)
+
+
+@ndb.tasklet
+def _slack_async(method, data):
+    while True:
+        resp = yield ndb.get_context().urlfetch(
+            'https://slack.com/api/%s' % method,
+            payload=json.dumps(data),
+            method='POST',
+            headers=main._slack_headers(),
+            deadline=deadline.current().timeout(critical=True))
+        if resp.status_code != 429:
+            break
+        # We're sending faster than Slack allows; wait as long as it asks,
+        # if we have the time.
+        retry_after = float(
+            resp.headers.get('Retry-After', _DEFAULT_RETRY_AFTER))
+        if retry_after >= deadline.current().remaining():
+            break
+        logging.info("Slack rate-limited %s; retrying after %ss"
+                     % (method, retry_after))
+        yield ndb.sleep(retry_after)
+    raise ndb.Return(json.loads(resp.content))
+
+
+@ndb.tasklet
+def _post_message_async(message, channel, username, icon_emoji,
+                        thread=None):
+    """Like main._send_to_slack: returns Slack's response, or None if we've
+    posted this message to the channel recently."""
+    if main._is_repeat(message, channel):
+        raise ndb.Return(None)
+    try:
+        msg = yield _slack_async('chat.postMessage', main._slack_post_data(
+            message, channel, username, icon_emoji, thread=thread))
+    except Exception:
+        main._forget_post(message, channel)
+        raise
+    if not msg.get('ok'):
+        main._forget_post(message, channel)
+    raise ndb.Return(msg)
+
+
+def _check_slack_results(method, channels, results):
+    """Raise SlackError if Slack didn't accept any of these calls.
+
+    `results` are Slack's responses for the calls to each of `channels`, or
+    None for posts we skipped as repeats.  We only raise once they've all
+    finished, so one bad channel doesn't stop us recording the rest.
+    """
+    failures = ['%s (%s)' % (channel, msg.get('error'))
+                for channel, msg in zip(channels, results)
+                if msg is not None and not msg.get('ok')]
+    if failures:
+        raise SlackError("%s failed for %s" % (method, ', '.join(failures)))
+
+
+@ndb.tasklet
+def _repository_phid_async(diff_id):
+    """Like main._repository_phid_from_diff_id."""
+    diffs = yield conduit_async('differential.query', ids=[diff_id])
+    raise ndb.Return(diffs[0]['repositoryPHID'] if diffs else None)
+
+
+@ndb.tasklet
+def _callsign_async(repo_phid):
+    """Like main._callsign_from_repository_phid."""
+    repos = yield conduit_async('repository.query', phids=[repo_phid])
+    raise ndb.Return(repos[0]['callsign'] if repos else None)
+
+
+# Map from each call main's step generators may ask for to a tasklet making
+# it, like main._STEP_CALLS.
+_STEP_CALLS = {
+    'transactions': lambda phid, phid_map, after: conduit_async(
+        'transaction.search',
+        **main._transaction_search_params(phid, phid_map, after)),
+    'repository-phid': _repository_phid_async,
+    'callsign': _callsign_async,
+    'phid-query': lambda phid: conduit_async(
+        'phid.query', critical=True, phids=[phid]),
+    'diff-callsign': lambda diff_id: _callsign_from_diff_id_async(diff_id),
+}
+
+
+@ndb.tasklet
+def _run_steps_async(steps):
+    """Like main._run_steps, but makes the calls as tasklets, and returns a
+    list of the outputs."""
+    outputs = []
+    value = exc_info = None
+    while True:
+        try:
+            if exc_info:
+                step = steps.throw(*exc_info)
+            else:
+                step = steps.send(value)
+        except StopIteration:
+            raise ndb.Return(outputs)
+        value = exc_info = None
+        if not isinstance(step, main._StepCall):
+            outputs.append(step)
+            continue
+        try:
+            value = yield _STEP_CALLS[step.name](*step.args)
+        except Exception:
+            exc_info = sys.exc_info()
+
+
+@ndb.tasklet
+def _step_result_async(steps):
+    """Like main._step_result."""
+    outputs = yield _run_steps_async(steps)
+    raise ndb.Return(outputs[0] if outputs else None)
+
+
+@_shared
+def _callsign_from_diff_id_async(diff_id):
+    """Like main._callsign_from_diff_id."""
+    return _step_result_async(main._callsign_steps(diff_id))
+
+
+@_shared
+def _object_info_async(phid):
+    """Like main._object_info_from_phid."""
+    return _step_result_async(main._object_info_steps(phid))
+
+
+@_shared
+@ndb.tasklet
+def _author_async(author_phid):
+    """Like main._author_from_phid, except we never load the user index."""
+    user = user_index.by_phid(author_phid)
+    if user is not None:
+        raise ndb.Return(
+            (user.username, user_index.mention(user.username)))
+    resp = yield conduit_async(
+        'user.search', constraints={'phids': [author_phid]})
+    username = (resp['data'][0]['fields']['username']
+                if resp and resp['data'] else None)
+    raise ndb.Return((username, username))
+
+
+@ndb.tasklet
+def handle_phabricator_async(request_body):
+    """Handle a new-style Phabricator webhook, like main.PhabricatorFox."""
+    phid = request_body['object']['phid']
+    if not request_body['transactions']:
+        raise ndb.Return('OK')
+    phid_map = {'phids': [t['phid'] for t in request_body['transactions']]}
+
+    first_page = yield _STEP_CALLS['transactions'](phid, phid_map, None)
+    if not first_page:
+        raise ndb.Return("No response found for phid: %s" % phid)
+    transactions = yield _run_steps_async(main._transaction_steps(
+        phid, phid_map, first_page, main.ACTIONS_MAP))
+
+    if not transactions:
+        raise ndb.Return('OK')
+
+    (phid_info, repo_callsign), authors = yield (
+        _object_info_async(phid),
+        [_author_async(t['authorPHID']) for t in transactions])
+    if not phid_info:
+        raise ndb.Return("No info found for %s" % phid)
+
+    # We don't use main's Fox digest here: it posts with blocking HTTP, and
+    # _slack_async already waits out Slack's rate limits.
+    channels = []
+    sends = []
+    for transaction, (author, author_mention) in zip(transactions, authors):
+        message = main._build_slack_message(
+            phid_info, transaction['type'], author_mention)
+        for channel in (set(['#1s-and-0s-commits']) |
+                        main._extra_channels(repo_callsign, author)):
+            channels.append(channel)
+            sends.append(_post_message_async(
+                message, channel, 'Phabricator Fox', ':fox:'))
+    results = yield sends
+    _check_slack_results('chat.postMessage', channels, results)
+    raise ndb.Return('OK')
+
+
+@ndb.tasklet
+def _post_incident_async(incident):
+    """Like main.PagerParrot._post_incident, but posts to all channels at
+    once."""
+    should_ping = pager_parrot.consider_ping(
+        incident.get('service', {}).get('id'))
+    routing = pager_parrot.routing()
+    channels = list(pager_parrot.channels_for_incident(incident, routing))
+    texts = [pager_parrot.format_message(
+        incident, channel, should_ping=should_ping, routing=routing)
+        for channel in channels]
+    results = yield [
+        _post_message_async(
+            text, channel, 'Pager Parrot', ':parrot:',
+            thread=pager_parrot.get_channel_thread(channel, routing))
+        for channel, text in zip(channels, texts)]
+    for channel, text, msg in zip(channels, texts, results):
+        if msg and 'ts' in msg:
+            pager_parrot.set_channel_thread(channel, msg['ts'], routing)
+            pager_parrot.record_incident_message(
+                incident['id'], msg['channel'], msg['ts'], text)
+    _check_slack_results('chat.postMessage', channels, results)
+
+
+@ndb.tasklet
+def _update_message_async(text, channel_id, ts):
+    """Update one message we posted, returning Slack's response.
+
+    If the call raises, we return it as a failed response instead, so one
+    bad channel doesn't stop us updating the others.
+    """
+    try:
+        msg = yield _slack_async('chat.update', {
+            'text': text,
+            'channel': channel_id,
+            'ts': ts,
+            'link_names': 1,
+        })
+    except Exception as e:
+        logging.exception("Couldn't update %s in %s" % (ts, channel_id))
+        msg = {'ok': False, 'error': str(e)}
+    raise ndb.Return(msg)
+
+
+@ndb.tasklet
+def _update_incident_async(incident, message_type):
+    """Like main.PagerParrot._update_incident."""
+    posts = pager_parrot.incident_messages(incident['id'])
+    results = yield [
+        _update_message_async(
+            pager_parrot.format_status_update(text, message_type, incident),
+            channel_id, ts)
+        for channel_id, ts, text in posts]
+    _check_slack_results('chat.update',
+                         [channel_id for channel_id, _, _ in posts], results)
+    # Once it's resolved, we won't need to update it again.
+    if message_type == 'incident.resolve':
+        pager_parrot.forget_incident_messages(incident['id'])
+
+
+@ndb.tasklet
+def _after_async(previous, func, *args):
+    """Wait for the `previous` Future, if any, then run the tasklet func."""
+    if previous is not None:
+        try:
+            yield previous
+        except Exception:
+            # It's reported with its own delivery; we carry on regardless.
+            pass
+    yield func(*args)
+
+
+def _in_incident_order(incidents, incident, func, *args):
+    """Run the tasklet func(*args) once earlier work on `incident` is done.
+
+    A replay can send an incident's trigger and its resolve together, and
+    we can't update the trigger's posts until we've made them.
+    """
+    future = _after_async(incidents.get(incident['id']), func, *args)
+    incidents[incident['id']] = future
+    return future
+
+
+@ndb.tasklet
+def _mark_seen_async(message_id, work):
+    """Wait for `work`, then mark the PagerDuty message as handled.
+
+    Like main.PagerParrot, we only do so once it's worked, so that a
+    replay of a message that failed tries it again.
+    """
+    yield work
+    main.pagerduty_ids_seen.add(message_id)
+
+
+@ndb.tasklet
+def handle_pagerduty_async(payload):
+    """Handle a PagerDuty webhook, like main.PagerParrot."""
+    incidents = getattr(_batch, 'incidents', None)
+    if incidents is None:
+        incidents = {}
+    started = getattr(_batch, 'pagerduty_ids', None)
+    if started is None:
+        started = set()
+    work = []
+    for message in payload['messages']:
+        if (message['id'] in main.pagerduty_ids_seen or
+                message['id'] in started):
+            continue
+        # Another delivery in this batch may have the same message.
+        started.add(message['id'])
+        incident = message['data']['incident']
+        if message['type'] == 'incident.trigger':
+            work.append(_mark_seen_async(message['id'], _in_incident_order(
+                incidents, incident, _post_incident_async, incident)))
+        elif message['type'] in pager_parrot.LIFECYCLE_STATUSES:
+            work.append(_mark_seen_async(message['id'], _in_incident_order(
+                incidents, incident, _update_incident_async, incident,
+                message['type'])))
+        else:
+            main.pagerduty_ids_seen.add(message['id'])
+    yield work
+    raise ndb.Return('OK')
+
+
+_HANDLERS = {
+    'phabricator': handle_phabricator_async,
+    'pagerduty': handle_pagerduty_async,
+}
+
+
+@ndb.tasklet
+def _handle_one_async(kind, payload):
+    try:
+        result = yield _HANDLERS[kind](payload)
+    except Exception as e:
+        logging.exception("Error handling %s delivery" % kind)
+        result = 'Error: %s' % e
+    raise ndb.Return(result)
+
+
+@ndb.tasklet
+def _handle_all_async(deliveries):
+    results = yield [_handle_one_async(kind, payload)
+                     for kind, payload in deliveries]
+    raise ndb.Return(results)
+
+
+def handle_many(deliveries):
+    """Handle (kind, payload) deliveries concurrently.
+
+    Returns a list with a result for each: 'OK', or a description of what
+    went wrong.
+    """
+    # Checking for new routing can read the datastore, which runs other
+    # tasklets while it waits; make sure the first load isn't one of them,
+    # or they'd find no routing at all.
+    main._routing.get()
+    pager_parrot.routing()
+    results = []
+    for i in xrange(0, len(deliveries), _MAX_IN_FLIGHT):
+        _batch.lookups = {}
+        _batch.incidents = {}
+        _batch.pagerduty_ids = set()
+        try:
+            results.extend(_handle_all_async(
+                deliveries[i:i + _MAX_IN_FLIGHT]).get_result())
+        finally:
+            _batch.lookups = None
+            _batch.incidents = None
+            _batch.pagerduty_ids = None
+    return results
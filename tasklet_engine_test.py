@@ -0,0 +1,279 @@
+import unittest
+
+import mock
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import deadline
+import dedupe
+import diff_index
+import main
+import pager_parrot
+import tasklet_engine
+
+
+class TaskletEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.addCleanup(self.testbed.deactivate)
+        ndb.get_context().clear_cache()
+
+        self.conduit_calls = []
+        self.slack_calls = []
+        self.slack_texts = []
+        # Map from channel to the error Slack gives for posts to it.
+        self.slack_errors = {}
+        self.conduit_results = {}
+        for patcher in [
+                mock.patch('tasklet_engine.conduit_async',
+                           self._fake_conduit_async),
+                mock.patch('tasklet_engine._slack_async',
+                           self._fake_slack_async),
+                mock.patch('main._slack_dedupe', dedupe.Dedupe(600)),
+                mock.patch('main._callsigns_from_repo_urls',
+                           return_value=set()),
+                mock.patch('main.pagerduty_ids_seen', set()),
+                mock.patch.dict(diff_index._index, clear=True),
+                mock.patch.dict(pager_parrot._incident_messages, clear=True),
+                mock.patch('pager_parrot.channels_for_incident',
+                           return_value={'#a', '#b'}),
+                mock.patch('pager_parrot.format_message',
+                           return_value='Oh no!'),
+                mock.patch('pager_parrot.consider_ping', return_value=True),
+                mock.patch('pager_parrot.get_channel_thread',
+                           return_value=None),
+                mock.patch('pager_parrot.set_channel_thread')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @ndb.tasklet
+    def _fake_conduit_async(self, method, **params):
+        self.conduit_calls.append(method)
+        yield ndb.sleep(0)
+        result = self.conduit_results[method]
+        if callable(result):
+            result = result(**params)
+        raise ndb.Return(result)
+
+    @ndb.tasklet
+    def _fake_slack_async(self, method, data):
+        self.slack_calls.append((method, data['channel']))
+        self.slack_texts.append(data['text'])
+        yield ndb.sleep(0)
+        if data['channel'] in self.slack_errors:
+            raise ndb.Return(
+                {'ok': False, 'error': self.slack_errors[data['channel']]})
+        raise ndb.Return({'ok': True, 'channel': data['channel'].upper(),
+                          'ts': '1.1'})
+
+    def test_phabricator(self):
+        self.conduit_results = {
+            'transaction.search': {'data': [
+                {'phid': 'PHID-1', 'type': 'comment'},
+                {'phid': 'PHID-2', 'type': 'create',
+                 'authorPHID': 'PHID-USER'}]},
+            'phid.query': {'PHID-DREV': {
+                'uri': 'https://test', 'name': 'D123',
+                'fullName': 'D123: test'}},
+            'differential.query': [{'repositoryPHID': 'PHID-REPO'}],
+            'repository.query': [{'callsign': 'GWA'}],
+            'user.search': {'data': [{'fields': {'username': 'dhruv'}}]},
+        }
+        results = tasklet_engine.handle_many([('phabricator', {
+            'object': {'phid': 'PHID-DREV'},
+            'transactions': [{'phid': 'PHID-1'}, {'phid': 'PHID-2'}],
+        })])
+        self.assertEqual(results, ['OK'])
+        self.assertEqual(diff_index.get(123), ('PHID-REPO', 'GWA'))
+        self.assertEqual(sorted(self.slack_calls),
+                         [('chat.postMessage', '#1s-and-0s-commits'),
+                          ('chat.postMessage', '#classroom-eng')])
+        self.assertIn('(created by dhruv)', self.slack_texts[0])
+
+    def test_lookups_shared_within_batch(self):
+        self.conduit_results = {
+            'transaction.search': {'data': [
+                {'phid': 'PHID-1', 'type': 'create',
+                 'authorPHID': 'PHID-USER'}]},
+            'phid.query': {'PHID-DREV': {
+                'uri': 'https://test', 'name': 'D123',
+                'fullName': 'D123: test'}},
+            'differential.query': [{'repositoryPHID': 'PHID-REPO'}],
+            'repository.query': [{'callsign': 'GWA'}],
+            'user.search': {'data': [{'fields': {'username': 'dhruv'}}]},
+        }
+        delivery = ('phabricator', {
+            'object': {'phid': 'PHID-DREV'},
+            'transactions': [{'phid': 'PHID-1'}],
+        })
+        self.assertEqual(tasklet_engine.handle_many([delivery] * 3),
+                         ['OK'] * 3)
+        self.assertEqual(self.conduit_calls.count('transaction.search'), 3)
+        for method in ('phid.query', 'differential.query',
+                       'repository.query', 'user.search'):
+            self.assertEqual(self.conduit_calls.count(method), 1)
+
+    def test_paging_stops_when_budget_used_up(self):
+        def transaction_search(**params):
+            if 'after' in params:
+                raise deadline.BudgetExhausted('no time')
+            return {'data': [{'phid': 'PHID-1', 'type': 'create',
+                              'authorPHID': 'PHID-USER'}],
+                    'cursor': {'after': '1'}}
+
+        self.conduit_results = {
+            'transaction.search': transaction_search,
+            'phid.query': {'PHID-DREV': {
+                'uri': 'https://test', 'name': 'D123',
+                'fullName': 'D123: test'}},
+            'differential.query': [{'repositoryPHID': 'PHID-REPO'}],
+            'repository.query': [{'callsign': 'GWA'}],
+            'user.search': {'data': [{'fields': {'username': 'dhruv'}}]},
+        }
+        results = tasklet_engine.handle_many([('phabricator', {
+            'object': {'phid': 'PHID-DREV'},
+            'transactions': [{'phid': 'PHID-1'}, {'phid': 'PHID-2'}],
+        })])
+        self.assertEqual(results, ['OK'])
+        self.assertEqual(self.conduit_calls.count('transaction.search'), 2)
+        self.assertIn('(created by dhruv)', self.slack_texts[0])
+
+    def test_pagerduty(self):
+        def delivery(message_id, message_type):
+            return ('pagerduty', {'messages': [{
+                'id': message_id, 'type': message_type,
+                'data': {'incident': {'id': 'PINCIDENT'}}}]})
+
+        self.assertEqual(
+            tasklet_engine.handle_many([delivery('1', 'incident.trigger'),
+                                        delivery('1', 'incident.trigger')]),
+            ['OK', 'OK'])
+        self.assertEqual(sorted(self.slack_calls),
+                         [('chat.postMessage', '#a'),
+                          ('chat.postMessage', '#b')])
+        tasklet_engine.handle_many([delivery('2', 'incident.resolve')])
+        self.assertEqual(sorted(self.slack_calls[2:]),
+                         [('chat.update', '#A'), ('chat.update', '#B')])
+
+    def test_incident_messages_in_order(self):
+        def message(message_id, message_type):
+            return {'id': message_id, 'type': message_type,
+                    'data': {'incident': {'id': 'PINCIDENT'}}}
+
+        results = tasklet_engine.handle_many([
+            ('pagerduty', {'messages': [message('1', 'incident.trigger'),
+                                        message('2', 'incident.acknowledge')]}),
+            ('pagerduty', {'messages': [message('3', 'incident.resolve')]}),
+        ])
+        self.assertEqual(results, ['OK', 'OK'])
+        # The trigger's posts go out before anything updates them.
+        self.assertEqual(sorted(self.slack_calls[:2]),
+                         [('chat.postMessage', '#a'),
+                          ('chat.postMessage', '#b')])
+        self.assertEqual(sorted(self.slack_calls[2:]),
+                         [('chat.update', '#A'), ('chat.update', '#A'),
+                          ('chat.update', '#B'), ('chat.update', '#B')])
+        self.assertEqual(pager_parrot.incident_messages('PINCIDENT'), [])
+
+    def test_rejected_posts_reported(self):
+        self.slack_errors = {'#b': 'channel_not_found'}
+        results = tasklet_engine.handle_many([('pagerduty', {'messages': [{
+            'id': '1', 'type': 'incident.trigger',
+            'data': {'incident': {'id': 'PINCIDENT'}}}]})])
+        self.assertEqual(results, [
+            'Error: chat.postMessage failed for #b (channel_not_found)'])
+        # We still recorded the post that worked.
+        self.assertEqual(
+            [channel for channel, _, _ in
+             pager_parrot.incident_messages('PINCIDENT')], ['#A'])
+
+    def test_failed_message_not_seen(self):
+        delivery = ('pagerduty', {'messages': [{
+            'id': '1', 'type': 'incident.trigger',
+            'data': {'incident': {'id': 'PINCIDENT'}}}]})
+        self.slack_errors = {'#b': 'channel_not_found'}
+        self.assertTrue(
+            tasklet_engine.handle_many([delivery])[0].startswith('Error'))
+        self.assertNotIn('1', main.pagerduty_ids_seen)
+        self.slack_errors = {}
+        self.assertEqual(tasklet_engine.handle_many([delivery]), ['OK'])
+        self.assertIn('1', main.pagerduty_ids_seen)
+
+    def test_failed_resolve_kept_for_retry(self):
+        pager_parrot.record_incident_message('PINCIDENT', '#A', '1.1', 'a')
+        pager_parrot.record_incident_message('PINCIDENT', '#B', '2.2', 'b')
+        delivery = ('pagerduty', {'messages': [{
+            'id': '1', 'type': 'incident.resolve',
+            'data': {'incident': {'id': 'PINCIDENT'}}}]})
+        self.slack_errors = {'#A': 'ratelimited'}
+        self.assertEqual(tasklet_engine.handle_many([delivery]), [
+            'Error: chat.update failed for #A (ratelimited)'])
+        self.assertEqual(sorted(self.slack_calls),
+                         [('chat.update', '#A'), ('chat.update', '#B')])
+        self.assertEqual(len(pager_parrot.incident_messages('PINCIDENT')), 2)
+        self.slack_errors = {}
+        self.assertEqual(tasklet_engine.handle_many([delivery]), ['OK'])
+        self.assertEqual(pager_parrot.incident_messages('PINCIDENT'), [])
+
+    def test_repeated_posts_skipped(self):
+        def delivery(message_id):
+            return ('pagerduty', {'messages': [{
+                'id': message_id, 'type': 'incident.trigger',
+                'data': {'incident': {'id': 'PINCIDENT'}}}]})
+
+        tasklet_engine.handle_many([delivery('1')])
+        tasklet_engine.handle_many([delivery('2')])
+        self.assertEqual(len(self.slack_calls), 2)
+
+    def test_errors_are_per_delivery(self):
+        results = tasklet_engine.handle_many([
+            ('pagerduty', {'messages': []}),
+            ('pagerduty', {}),
+        ])
+        self.assertEqual(results[0], 'OK')
+        self.assertTrue(results[1].startswith('Error'))
+
+
+class SlackRateLimitTest(unittest.TestCase):
+    def setUp(self):
+        self.responses = []
+        for patcher in [
+                mock.patch('google.appengine.ext.ndb.get_context'),
+                mock.patch('main._slack_headers', return_value={})]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        ndb.get_context.return_value.urlfetch.side_effect = self._urlfetch
+
+    def _urlfetch(self, *args, **kwargs):
+        future = ndb.Future()
+        future.set_result(self.responses.pop(0))
+        return future
+
+    def _response(self, status_code, headers=None):
+        return mock.Mock(status_code=status_code, headers=headers or {},
+                         content='{"ok": %s}' % (
+                             'true' if status_code == 200 else 'false'))
+
+    def test_retries_after_rate_limit(self):
+        self.responses = [self._response(429, {'Retry-After': '0'}),
+                          self._response(200)]
+        with deadline.started(10):
+            result = tasklet_engine._slack_async(
+                'chat.postMessage', {}).get_result()
+        self.assertEqual(result, {'ok': True})
+        self.assertEqual(self.responses, [])
+
+    def test_gives_up_without_time_to_wait(self):
+        self.responses = [self._response(429, {'Retry-After': '30'}),
+                          self._response(200)]
+        with deadline.started(10):
+            result = tasklet_engine._slack_async(
+                'chat.postMessage', {}).get_result()
+        self.assertEqual(result, {'ok': False})
+
+
+if __name__ == '__main__':
+    unittest.main()
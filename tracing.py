@@ -0,0 +1,168 @@
+"""Trace spans for each request and the outbound calls it makes.
+
+A request handler runs inside `trace()`, and each interesting step inside it
+(parsing, each conduit call, routing, each Slack post) inside `span()` or a
+function decorated with `traced()`.  Spans record their parent, so a slow
+request can be broken down into the calls that made it slow.
+
+To keep the cost down, only a sample of requests are traced; for the rest,
+`span()` just checks for a current span and moves on.  Finished spans go into
+a bounded ring buffer, and are handed to the exporter in batches.  If the
+exporter can't keep up, the oldest spans are dropped.
+
+The current span lives in a thread-local; code that hands work to other
+threads must pass it along (as parallel.py does).
+"""
+import collections
+import contextlib
+import functools
+import json
+import logging
+import random
+import threading
+import time
+
+import memory
+
+
+# What fraction of requests to trace.
+_SAMPLE_RATE = 0.1
+
+# How many finished spans to hold on to, and how many to export at once.
+_BUFFER_SIZE = 10000
+_EXPORT_BATCH_SIZE = 200
+
+
+class Span(object):
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'start', 'end',
+                 'attributes')
+
+    def __init__(self, trace_id, parent_id, name, attributes):
+        self.trace_id = trace_id
+        self.span_id = '%016x' % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.time()
+        self.end = None
+        self.attributes = attributes
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration': self.end - self.start,
+            'attributes': self.attributes,
+        }
+
+
+def log_exporter(spans):
+    """Export spans to the log, for when there's no collector."""
+    for span in spans:
+        logging.debug('Span: %s' % json.dumps(span))
+
+
+class FileExporter(object):
+    """Export spans to a file, one JSON object per line."""
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, spans):
+        with open(self.path, 'a') as f:
+            for span in spans:
+                f.write(json.dumps(span) + '\n')
+
+
+_exporter = log_exporter
+_finished = collections.deque(maxlen=_BUFFER_SIZE)
+memory.register('tracing.finished_spans', lambda: _finished)
+_export_lock = threading.Lock()
+_local = threading.local()
+
+
+def set_exporter(exporter):
+    """Set the function that's called with each batch of finished spans,
+    as a list of dicts."""
+    global _exporter
+    _exporter = exporter
+
+
+def current_span():
+    return getattr(_local, 'span', None)
+
+
+@contextlib.contextmanager
+def installed(span):
+    """Make `span` the current span on this thread while in this block."""
+    previous = current_span()
+    _local.span = span
+    try:
+        yield span
+    finally:
+        _local.span = previous
+
+
+def _finish(span):
+    span.end = time.time()
+    _finished.append(span)
+    if len(_finished) >= _EXPORT_BATCH_SIZE:
+        export()
+
+
+def export():
+    """Send all the finished spans we have to the exporter."""
+    with _export_lock:
+        batch = []
+        while _finished:
+            batch.append(_finished.popleft().to_dict())
+        if not batch:
+            return
+        try:
+            _exporter(batch)
+        except Exception:
+            logging.exception("Unable to export %s spans" % len(batch))
+
+
+@contextlib.contextmanager
+def trace(name, **attributes):
+    """Start a new trace (if this request is sampled) with a root span."""
+    if random.random() >= _SAMPLE_RATE:
+        with installed(None):
+            yield None
+        return
+
+    root = Span('%016x' % random.getrandbits(64), None, name, attributes)
+    with installed(root):
+        try:
+            yield root
+        finally:
+            _finish(root)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Record a child of the current span, if we're tracing."""
+    parent = current_span()
+    if parent is None:
+        yield None
+        return
+
+    child = Span(parent.trace_id, parent.span_id, name, attributes)
+    with installed(child):
+        try:
+            yield child
+        finally:
+            _finish(child)
+
+
+def traced(name):
+    """Decorator to record a span for every call of a function."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
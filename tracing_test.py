@@ -0,0 +1,74 @@
+import unittest
+
+import mock
+
+import parallel
+import tracing
+
+
+class TracingTest(unittest.TestCase):
+    def setUp(self):
+        self.exported = []
+        for patcher in [
+                mock.patch('tracing._exporter', self.exported.extend),
+                mock.patch('tracing._finished',
+                           tracing.collections.deque(maxlen=5)),
+                mock.patch('tracing._SAMPLE_RATE', 1)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_parent_child_links(self):
+        @tracing.traced('call')
+        def call():
+            pass
+
+        with tracing.trace('/request') as root:
+            with tracing.span('parse'):
+                pass
+            parallel.start(call).result()
+        tracing.export()
+
+        spans = {span['name']: span for span in self.exported}
+        self.assertEqual(sorted(spans), ['/request', 'call', 'parse'])
+        self.assertIsNone(spans['/request']['parent_id'])
+        self.assertEqual(spans['parse']['parent_id'], root.span_id)
+        self.assertEqual(spans['call']['parent_id'], root.span_id)
+        self.assertEqual(set(s['trace_id'] for s in self.exported),
+                         {root.trace_id})
+
+    def test_unsampled(self):
+        with mock.patch('tracing._SAMPLE_RATE', 0):
+            with tracing.trace('/request') as root:
+                with tracing.span('parse') as child:
+                    pass
+        self.assertIsNone(root)
+        self.assertIsNone(child)
+        tracing.export()
+        self.assertEqual(self.exported, [])
+
+    def test_no_span_outside_trace(self):
+        with tracing.span('parse') as child:
+            self.assertIsNone(child)
+
+    def test_exported_in_batches(self):
+        with mock.patch('tracing._EXPORT_BATCH_SIZE', 3):
+            with tracing.trace('/request'):
+                for _ in xrange(3):
+                    with tracing.span('call'):
+                        pass
+                self.assertEqual(len(self.exported), 3)
+        tracing.export()
+        self.assertEqual(len(self.exported), 4)
+
+    def test_ring_buffer_drops_oldest(self):
+        with tracing.trace('/request'):
+            for i in xrange(10):
+                with tracing.span('call', i=i):
+                    pass
+        tracing.export()
+        self.assertEqual([s['attributes'].get('i') for s in self.exported],
+                         [6, 7, 8, 9, None])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+"""An index from Phabricator users to Slack users.
+
+Phabricator only tells us who did something by PHID (or, in the old feed, by
+username).  To @-mention them properly in Slack we need their Slack user ID,
+so we bulk-load both user lists every so often, join them by email, and keep
+the result in instance memory.
+
+The index is rebuilt off to the side and swapped in with a single assignment,
+so readers never need a lock and never see a half-built index.
+"""
+import collections
+import logging
+import time
+
+import memory
+
+
+User = collections.namedtuple('User', ['phid', 'username', 'slack_id'])
+
+# Phabricator doesn't expose users' email addresses over conduit, so for
+# users without one we assume the usual company address.
+_DEFAULT_EMAIL_DOMAIN = 'khanacademy.org'
+
+# (map from PHID to User, map from username to User, time we loaded it)
+_snapshot = ({}, {}, None)
+memory.register('user_index', lambda: _snapshot, count=lambda: size())
+
+
+def _phabricator_email(phabricator_user):
+    fields = phabricator_user['fields']
+    return (fields.get('email') or
+            '%s@%s' % (fields['username'], _DEFAULT_EMAIL_DOMAIN)).lower()
+
+
+def build(phabricator_users, slack_users):
+    """Join Phabricator users to Slack users by email.
+
+    `phabricator_users` are results from conduit's `user.search`, and
+    `slack_users` are members from Slack's `users.list`.  Returns maps from
+    PHID and from username to User; Phabricator users with no matching Slack
+    user are included, with a slack_id of None.
+    """
+    slack_ids_by_email = {}
+    for member in slack_users:
+        email = member.get('profile', {}).get('email')
+        if email and not member.get('deleted') and not member.get('is_bot'):
+            slack_ids_by_email[email.lower()] = member['id']
+
+    by_phid = {}
+    by_username = {}
+    for phabricator_user in phabricator_users:
+        user = User(
+            phid=phabricator_user['phid'],
+            username=phabricator_user['fields']['username'],
+            slack_id=slack_ids_by_email.get(
+                _phabricator_email(phabricator_user)))
+        by_phid[user.phid] = user
+        by_username[user.username] = user
+    return by_phid, by_username
+
+
+def replace(phabricator_users, slack_users):
+    """Rebuild the index from fresh user lists and swap it in."""
+    global _snapshot
+    by_phid, by_username = build(phabricator_users, slack_users)
+    _snapshot = (by_phid, by_username, time.time())
+    logging.info("User index has %s users, %s of them on Slack" % (
+        len(by_phid), sum(1 for u in by_phid.values() if u.slack_id)))
+
+
+def loaded():
+    return _snapshot[2] is not None
+
+
+def by_phid(phid):
+    return _snapshot[0].get(phid)
+
+
+def by_username(username):
+    return _snapshot[1].get(username)
+
+
+def mention(username):
+    """Return Slack markup that @-mentions a Phabricator user.
+
+    If we don't know their Slack account, this is just their username.
+    """
+    user = by_username(username)
+    if user and user.slack_id:
+        return '<@%s>' % user.slack_id
+    return username
+
+
+def size():
+    return len(_snapshot[0])
@@ -0,0 +1,56 @@
+import unittest
+
+import mock
+
+import user_index
+
+
+def _phabricator_user(phid, username, email=None):
+    fields = {'username': username}
+    if email:
+        fields['email'] = email
+    return {'phid': phid, 'fields': fields}
+
+
+def _slack_user(slack_id, email, **kwargs):
+    member = {'id': slack_id, 'profile': {'email': email}}
+    member.update(kwargs)
+    return member
+
+
+class UserIndexTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('user_index._snapshot', ({}, {}, None))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_join_by_default_email(self):
+        user_index.replace(
+            [_phabricator_user('PHID-USER-1', 'dhruv')],
+            [_slack_user('U1', 'Dhruv@khanacademy.org')])
+        self.assertEqual(user_index.by_phid('PHID-USER-1').slack_id, 'U1')
+        self.assertEqual(user_index.mention('dhruv'), '<@U1>')
+
+    def test_join_by_explicit_email(self):
+        user_index.replace(
+            [_phabricator_user('PHID-USER-1', 'kevinb', 'kb@example.com')],
+            [_slack_user('U1', 'kb@example.com'),
+             _slack_user('U2', 'kevinb@khanacademy.org')])
+        self.assertEqual(user_index.mention('kevinb'), '<@U1>')
+
+    def test_unmatched_users(self):
+        user_index.replace(
+            [_phabricator_user('PHID-USER-1', 'alice')],
+            [_slack_user('U1', 'alice@khanacademy.org', deleted=True)])
+        self.assertIsNone(user_index.by_phid('PHID-USER-1').slack_id)
+        self.assertEqual(user_index.mention('alice'), 'alice')
+        self.assertEqual(user_index.mention('nobody'), 'nobody')
+
+    def test_loaded(self):
+        self.assertFalse(user_index.loaded())
+        user_index.replace([], [])
+        self.assertTrue(user_index.loaded())
+
+
+if __name__ == '__main__':
+    unittest.main()